@@ -82,6 +82,22 @@ impl InstructionFormat {
             })
     }
 
+    /// Returns the fields bound when destructuring an `InstructionData` of this format: the
+    /// immediate fields, then `arg` or `ref args` for the value operands, if any.
+    pub fn data_pattern_fields(&self) -> Vec<&'static str> {
+        let mut fields = self
+            .imm_fields
+            .iter()
+            .map(|field| field.member)
+            .collect::<Vec<_>>();
+        if self.has_value_list || self.num_value_operands > 1 {
+            fields.push("ref args");
+        } else if self.num_value_operands == 1 {
+            fields.push("arg");
+        }
+        fields
+    }
+
     /// Returns a tuple that uniquely identifies the structure.
     pub fn structure(&self) -> FormatStructure {
         FormatStructure {
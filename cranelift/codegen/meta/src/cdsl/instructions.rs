@@ -1302,6 +1302,12 @@ impl Into<InstSpec> for BoundInstruction {
     }
 }
 
+impl Into<InstSpec> for &BoundInstruction {
+    fn into(self) -> InstSpec {
+        InstSpec::Bound(self.clone())
+    }
+}
+
 #[cfg(test)]
 mod test {
     use super::*;
@@ -48,7 +48,7 @@ impl Stack {
     }
 }
 
-#[derive(Clone, Hash, PartialEq)]
+#[derive(Copy, Clone, Hash, PartialEq)]
 pub(crate) struct BranchRange {
     pub inst_size: u64,
     pub range: u64,
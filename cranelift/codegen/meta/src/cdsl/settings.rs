@@ -117,6 +117,8 @@ pub(crate) struct SettingGroup {
     pub settings: Vec<Setting>,
     pub bool_start_byte_offset: u8,
     pub settings_size: u8,
+    /// Default value of each of the `settings_size` bytes.
+    pub default_bytes: Vec<u8>,
     pub presets: Vec<Preset>,
     pub predicates: Vec<Predicate>,
 }
@@ -368,6 +370,7 @@ impl SettingGroupBuilder {
             settings: Vec::new(),
             bool_start_byte_offset: 0,
             settings_size: 0,
+            default_bytes: Vec::new(),
             presets: Vec::new(),
             predicates: Vec::new(),
         };
@@ -423,6 +426,11 @@ impl SettingGroupBuilder {
         );
         group.settings_size = group.byte_size();
 
+        group.default_bytes = vec![0; group.settings_size as usize];
+        for setting in &group.settings {
+            group.default_bytes[setting.byte_offset as usize] |= setting.default_byte();
+        }
+
         // Sort predicates by name to ensure the same order as the Python code.
         let mut predicates = self.predicates;
         predicates.sort_by_key(|predicate| predicate.name);
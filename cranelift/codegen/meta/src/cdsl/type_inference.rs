@@ -651,7 +651,7 @@ pub(crate) fn infer_transform(
             "type sets can only get narrower"
         );
         if new_typeset != src_typeset {
-            type_env.add_constraint(Constraint::InTypeset(tv.clone(), new_typeset.clone()));
+            type_env.add_constraint(Constraint::InTypeset(tv, new_typeset));
         }
     }
 
@@ -566,7 +566,8 @@ impl TypeSet {
         copy
     }
 
-    fn concrete_types(&self) -> Vec<ValueType> {
+    /// Return every concrete type represented by this typeset.
+    pub fn concrete_types(&self) -> Vec<ValueType> {
         let mut ret = Vec::new();
         for &num_lanes in &self.lanes {
             for &bits in &self.ints {
@@ -98,7 +98,6 @@ impl Transform {
                 HashSet::from_iter(type_env.free_typevars(&mut var_pool));
             let src_tvs = HashSet::from_iter(
                 input_vars
-                    .clone()
                     .iter()
                     .chain(
                         defined_vars
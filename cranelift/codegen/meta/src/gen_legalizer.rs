@@ -1,5 +1,6 @@
 //! Generate transformations to legalize instructions without encodings.
 use crate::cdsl::ast::{Def, DefPool, Expr, VarPool};
+use crate::cdsl::instructions::Instruction;
 use crate::cdsl::isa::TargetIsa;
 use crate::cdsl::operands::Operand;
 use crate::cdsl::type_inference::Constraint;
@@ -7,10 +8,11 @@ use crate::cdsl::typevar::{TypeSet, TypeVar};
 use crate::cdsl::xform::{Transform, TransformGroup, TransformGroups};
 
 use crate::error;
-use crate::gen_inst::gen_typesets_table;
 use crate::srcgen::Formatter;
 use crate::unique_table::UniqueTable;
 
+use cranelift_entity::EntityRef;
+
 use std::collections::{HashMap, HashSet};
 use std::iter::FromIterator;
 
@@ -35,6 +37,17 @@ fn unwrap_inst(transform: &Transform, fmt: &mut Formatter) -> bool {
         def.to_comment_string(&transform.var_pool)
     ));
 
+    // Map each input operand number to its position among the immediate or value operands, so
+    // the operands can be looked up directly instead of searching `imm_opnums` / `value_opnums`
+    // for each of them.
+    let mut operand_positions = vec![0; inst.operands_in.len()];
+    for (n, &op_num) in inst.imm_opnums.iter().enumerate() {
+        operand_positions[op_num] = n;
+    }
+    for (n, &op_num) in inst.value_opnums.iter().enumerate() {
+        operand_positions[op_num] = n;
+    }
+
     // Extract the Var arguments.
     let arg_names = apply
         .args
@@ -46,10 +59,7 @@ fn unwrap_inst(transform: &Transform, fmt: &mut Formatter) -> bool {
         })
         .map(|(arg_num, arg)| match &arg {
             Expr::Var(var_index) => var_pool.get(*var_index).name.as_ref(),
-            Expr::Literal(_) => {
-                let n = inst.imm_opnums.iter().position(|&i| i == arg_num).unwrap();
-                iform.imm_fields[n].member
-            }
+            Expr::Literal(_) => iform.imm_fields[operand_positions[arg_num]].member,
         })
         .collect::<Vec<_>>()
         .join(", ");
@@ -93,16 +103,9 @@ fn unwrap_inst(transform: &Transform, fmt: &mut Formatter) -> bool {
 
     fmt.indent(|fmt| {
         // Fields are encoded directly.
-        for field in &iform.imm_fields {
-            fmtln!(fmt, "{},", field.member);
+        for field in iform.data_pattern_fields() {
+            fmtln!(fmt, "{},", field);
         }
-
-        if iform.has_value_list || iform.num_value_operands > 1 {
-            fmt.line("ref args,");
-        } else if iform.num_value_operands == 1 {
-            fmt.line("arg,");
-        }
-
         fmt.line("..");
         fmt.outdented_line("} = pos.func.dfg[inst] {");
 
@@ -117,10 +120,10 @@ fn unwrap_inst(transform: &Transform, fmt: &mut Formatter) -> bool {
             |fmt: &mut Formatter, needs_comma: bool, op_num: usize, op: &Operand| {
                 let comma = if needs_comma { "," } else { "" };
                 if op.is_immediate_or_entityref() {
-                    let n = inst.imm_opnums.iter().position(|&i| i == op_num).unwrap();
+                    let n = operand_positions[op_num];
                     fmtln!(fmt, "{}{}", iform.imm_fields[n].member, comma);
                 } else if op.is_value() {
-                    let n = inst.value_opnums.iter().position(|&i| i == op_num).unwrap();
+                    let n = operand_positions[op_num];
                     fmtln!(fmt, "pos.func.dfg.resolve_aliases(args[{}]),", n);
                 } else {
                     // This is a value list argument or a varargs.
@@ -263,61 +266,146 @@ fn build_derived_expr(tv: &TypeVar) -> String {
     )
 }
 
-/// Emit rust code for the given check.
-///
-/// The emitted code is a statement redefining the `predicate` variable like this:
-///     let predicate = predicate && ...
-fn emit_runtime_typecheck<'a>(
+/// Render the given check as a Rust boolean expression.
+fn runtime_typecheck_expr<'a>(
     constraint: &'a Constraint,
     type_sets: &mut UniqueTable<'a, TypeSet>,
-    fmt: &mut Formatter,
-) {
+) -> String {
     match constraint {
         Constraint::InTypeset(tv, ts) => {
             let ts_index = type_sets.add(&ts);
-            fmt.comment(format!(
-                "{} must belong to {:?}",
-                tv.name,
-                type_sets.get(ts_index)
-            ));
-            fmtln!(
-                fmt,
-                "let predicate = predicate && TYPE_SETS[{}].contains({});",
-                ts_index,
-                tv.name
-            );
+            format!("ts_contains(&TYPE_SETS[{}], {})", ts_index, tv.name)
         }
-        Constraint::Eq(tv1, tv2) => {
-            fmtln!(
-                fmt,
-                "let predicate = predicate && match ({}, {}) {{",
-                build_derived_expr(tv1),
-                build_derived_expr(tv2)
-            );
-            fmt.indent(|fmt| {
-                fmt.line("(Some(a), Some(b)) => a == b,");
-                fmt.comment("On overflow, constraint doesn\'t apply");
-                fmt.line("_ => false,");
-            });
-            fmtln!(fmt, "};");
+        Constraint::Eq(tv1, tv2) => format!(
+            "match ({}, {}) {{\n    (Some(a), Some(b)) => a == b,\n    \
+             // On overflow, constraint doesn\'t apply\n    _ => false,\n}}",
+            build_derived_expr(tv1),
+            build_derived_expr(tv2)
+        ),
+        Constraint::WiderOrEq(tv1, tv2) => format!(
+            "match ({}, {}) {{\n    (Some(a), Some(b)) => a.wider_or_equal(b),\n    \
+             // On overflow, constraint doesn\'t apply\n    _ => false,\n}}",
+            build_derived_expr(tv1),
+            build_derived_expr(tv2)
+        ),
+    }
+}
+
+/// Collect the names of the `typeof_*` locals a check reads, in order of appearance.
+fn runtime_typecheck_params(constraint: &Constraint) -> Vec<String> {
+    fn root_name(tv: &TypeVar) -> String {
+        match &tv.base {
+            Some(base) => root_name(&base.type_var),
+            None => tv.name.clone(),
         }
-        Constraint::WiderOrEq(tv1, tv2) => {
-            fmtln!(
-                fmt,
-                "let predicate = predicate && match ({}, {}) {{",
-                build_derived_expr(tv1),
-                build_derived_expr(tv2)
-            );
-            fmt.indent(|fmt| {
-                fmt.line("(Some(a), Some(b)) => a.wider_or_equal(b),");
-                fmt.comment("On overflow, constraint doesn\'t apply");
-                fmt.line("_ => false,");
-            });
-            fmtln!(fmt, "};");
+    }
+    let mut params = match constraint {
+        Constraint::InTypeset(tv, _) => vec![root_name(tv)],
+        Constraint::Eq(tv1, tv2) | Constraint::WiderOrEq(tv1, tv2) => {
+            vec![root_name(tv1), root_name(tv2)]
+        }
+    };
+    params.dedup();
+    params
+}
+
+/// Minimum number of identical runtime checks in a generated file before they get shared
+/// through a helper function rather than being inlined at each use.
+const TYPECHECK_HELPER_THRESHOLD: usize = 4;
+
+/// The runtime checks of all the transforms in a generated file, rendered once up front.
+///
+/// Checks that are used often enough are emitted once, as helper functions.
+struct RuntimeTypechecks {
+    /// The expression evaluating each check, indexed by group, then by transform within the
+    /// group, then by constraint within the transform's type environment.
+    exprs: Vec<Vec<Vec<String>>>,
+    /// The rendered check and parameter names of each helper function.
+    helpers: Vec<(String, Vec<String>)>,
+}
+
+impl RuntimeTypechecks {
+    /// Render every runtime check of the given groups and share the most duplicated ones.
+    fn collect<'a>(
+        groups: &[&'a TransformGroup],
+        type_sets: &mut UniqueTable<'a, TypeSet>,
+    ) -> Self {
+        let mut counts: HashMap<String, usize> = HashMap::new();
+        let mut in_order = Vec::new();
+        let mut rendered = Vec::new();
+        for group in groups {
+            let mut group_exprs = Vec::with_capacity(group.transforms.len());
+            for transform in &group.transforms {
+                let mut transform_exprs = Vec::with_capacity(transform.type_env.constraints.len());
+                for constraint in &transform.type_env.constraints {
+                    let expr = runtime_typecheck_expr(constraint, type_sets);
+                    let count = counts.entry(expr.clone()).or_insert(0);
+                    if *count == 0 {
+                        in_order.push((expr.clone(), runtime_typecheck_params(constraint)));
+                    }
+                    *count += 1;
+                    transform_exprs.push(expr);
+                }
+                group_exprs.push(transform_exprs);
+            }
+            rendered.push(group_exprs);
+        }
+
+        let helpers = in_order
+            .into_iter()
+            .filter(|(expr, _)| counts[expr] >= TYPECHECK_HELPER_THRESHOLD)
+            .collect::<Vec<_>>();
+        let helper_calls = helpers
+            .iter()
+            .enumerate()
+            .map(|(i, (expr, params))| (expr, format!("typecheck_{}({})", i, params.join(", "))))
+            .collect::<HashMap<_, _>>();
+        let mut exprs = rendered;
+        for expr in exprs.iter_mut().flatten().flatten() {
+            if let Some(call) = helper_calls.get(expr) {
+                *expr = call.clone();
+            }
+        }
+        Self { exprs, helpers }
+    }
+
+    /// The rendered checks of the `index`-th group passed to `collect`, one list per transform.
+    fn group_checks(&self, index: usize) -> &[Vec<String>] {
+        &self.exprs[index]
+    }
+
+    /// Emit the shared helper functions.
+    fn gen_helpers(&self, fmt: &mut Formatter) {
+        for (i, (expr, params)) in self.helpers.iter().enumerate() {
+            fmt.line("#[inline(always)]");
+            let params = params
+                .iter()
+                .map(|name| format!("{}: ir::Type", name))
+                .collect::<Vec<_>>()
+                .join(", ");
+            fmtln!(fmt, "fn typecheck_{}({}) -> bool {{", i, params);
+            fmt.indent(|fmt| fmt.multi_line(expr));
+            fmt.line("}");
+            fmt.empty_line();
         }
     }
 }
 
+/// Emit rust code for the given check.
+///
+/// The emitted code is a statement redefining the `predicate` variable like this:
+///     let predicate = predicate && ...
+///
+/// If `first` is set, there is no prior predicate to chain with, and the check defines
+/// `predicate` on its own.
+fn emit_runtime_typecheck(constraint: &Constraint, first: bool, expr: &str, fmt: &mut Formatter) {
+    if let Constraint::InTypeset(tv, ts) = constraint {
+        fmt.comment(format!("{} must belong to {:?}", tv.name, ts));
+    }
+    let chain = if first { "" } else { "predicate && " };
+    fmt.multi_line(&format!("let predicate = {}{};", chain, expr));
+}
+
 /// Determine if `node` represents one of the value splitting instructions: `isplit` or `vsplit.
 /// These instructions are lowered specially by the `legalize::split` module.
 fn is_value_split(def: &Def) -> bool {
@@ -325,6 +413,11 @@ fn is_value_split(def: &Def) -> bool {
     name == "isplit" || name == "vsplit"
 }
 
+/// Emit code that builds the destination instruction `def`.
+///
+/// New instructions go through `pos.ins()` rather than assembling `InstructionData` by hand: the
+/// `InstBuilder` methods are statically dispatched and inlined, and they already take care of
+/// controlling type variable inference, result value reuse and source locations.
 fn emit_dst_inst(def: &Def, def_pool: &DefPool, var_pool: &VarPool, fmt: &mut Formatter) {
     let defined_vars = {
         let vars = def
@@ -431,10 +524,10 @@ fn emit_dst_inst(def: &Def, def_pool: &DefPool, var_pool: &VarPool, fmt: &mut Fo
 ///
 /// `inst: Inst` is the variable to be replaced. It is pointed to by `pos: Cursor`.
 /// `dfg: DataFlowGraph` is available and mutable.
-fn gen_transform<'a>(
+fn gen_transform(
     replace_inst: bool,
-    transform: &'a Transform,
-    type_sets: &mut UniqueTable<'a, TypeSet>,
+    transform: &Transform,
+    typechecks: &[String],
     fmt: &mut Formatter,
 ) {
     // Evaluate the instruction predicate if any.
@@ -447,17 +540,24 @@ fn gen_transform<'a>(
     let has_extra_constraints = !transform.type_env.constraints.is_empty();
     if has_extra_constraints {
         // Extra constraints rely on the predicate being a variable that we can rebind as we add
-        // more constraint predicates.
+        // more constraint predicates. Without an instruction predicate, the first constraint
+        // defines it, so we don't emit a statically true `predicate` to start from.
         if let Some(pred) = &inst_predicate {
             fmt.multi_line(&format!("let predicate = {};", pred));
-        } else {
-            fmt.line("let predicate = true;");
         }
     }
 
     // Emit any runtime checks; these will rebind `predicate` emitted right above.
-    for constraint in &transform.type_env.constraints {
-        emit_runtime_typecheck(constraint, type_sets, fmt);
+    assert_eq!(typechecks.len(), transform.type_env.constraints.len());
+    for (i, (constraint, expr)) in transform
+        .type_env
+        .constraints
+        .iter()
+        .zip(typechecks)
+        .enumerate()
+    {
+        let first = i == 0 && inst_predicate.is_none();
+        emit_runtime_typecheck(constraint, first, expr, fmt);
     }
 
     let do_expand = |fmt: &mut Formatter| {
@@ -479,6 +579,10 @@ fn gen_transform<'a>(
 
         // If we're going to delete `inst`, we need to detach its results first so they can be
         // reattached during pattern expansion.
+        //
+        // This can't be fused into the unwrapping code emitted by `unwrap_inst`: that code is
+        // shared by all the transforms of an opcode, and the results must stay attached if this
+        // transform's predicate fails and a later one (or the chained group) gets to run.
         if !replace_inst {
             fmt.line("pos.func.dfg.clear_results(inst);");
         }
@@ -553,10 +657,10 @@ fn gen_transform<'a>(
     }
 }
 
-fn gen_transform_group<'a>(
-    group: &'a TransformGroup,
+fn gen_transform_group(
+    group: &TransformGroup,
     transform_groups: &TransformGroups,
-    type_sets: &mut UniqueTable<'a, TypeSet>,
+    typechecks: &[Vec<String>],
     fmt: &mut Formatter,
 ) {
     fmt.doc_comment(group.doc);
@@ -579,39 +683,45 @@ fn gen_transform_group<'a>(
         fmt.line("let mut pos = FuncCursor::new(func).at_inst(inst);");
         fmt.line("pos.use_srcloc(inst);");
 
-        // Group the transforms by opcode so we can generate a big switch.
-        // Preserve ordering.
-        let mut inst_to_transforms = HashMap::new();
-        for transform in &group.transforms {
-            let def_index = transform.src;
-            let inst = &transform.def_pool.get(def_index).apply.inst;
-            inst_to_transforms
-                .entry(inst.camel_name.clone())
-                .or_insert_with(Vec::new)
-                .push(transform);
+        // Group the transforms by opcode so we can generate a big switch. Opcode numbers are
+        // dense, so bucket them by index: this also sorts the groups by opcode number.
+        // Preserve ordering within a group.
+        fn src_inst(transform: &Transform) -> &Instruction {
+            &transform.def_pool.get(transform.src).apply.inst
+        }
+        let num_opcodes = group
+            .transforms
+            .iter()
+            .map(|transform| src_inst(transform).opcode_number.index() + 1)
+            .max()
+            .unwrap_or(0);
+        assert_eq!(typechecks.len(), group.transforms.len());
+        let mut transforms_by_opcode = vec![Vec::new(); num_opcodes];
+        for (transform, checks) in group.transforms.iter().zip(typechecks) {
+            let opcode_number = src_inst(transform).opcode_number;
+            transforms_by_opcode[opcode_number.index()].push((transform, checks));
         }
-
-        let mut sorted_inst_names = Vec::from_iter(inst_to_transforms.keys());
-        sorted_inst_names.sort();
 
         fmt.line("{");
         fmt.indent(|fmt| {
             fmt.line("match pos.func.dfg[inst].opcode() {");
             fmt.indent(|fmt| {
-                for camel_name in sorted_inst_names {
-                    fmtln!(fmt, "ir::Opcode::{} => {{", camel_name);
+                for transforms in transforms_by_opcode.iter().filter(|t| !t.is_empty()) {
+                    fmtln!(
+                        fmt,
+                        "ir::Opcode::{} => {{",
+                        src_inst(transforms[0].0).camel_name
+                    );
                     fmt.indent(|fmt| {
-                        let transforms = inst_to_transforms.get(camel_name).unwrap();
-
                         // Unwrap the source instruction, create local variables for the input variables.
-                        let replace_inst = unwrap_inst(&transforms[0], fmt);
+                        let replace_inst = unwrap_inst(transforms[0].0, fmt);
                         fmt.empty_line();
 
-                        for (i, transform) in transforms.iter().enumerate() {
+                        for (i, (transform, checks)) in transforms.iter().enumerate() {
                             if i > 0 {
                                 fmt.empty_line();
                             }
-                            gen_transform(replace_inst, transform, type_sets, fmt);
+                            gen_transform(replace_inst, transform, checks, fmt);
                         }
                     });
                     fmtln!(fmt, "}");
@@ -653,17 +763,59 @@ fn gen_transform_group<'a>(
     fmt.empty_line();
 }
 
-/// Generate legalization functions for `isa` and add any shared `TransformGroup`s
-/// encountered to `shared_groups`.
+/// Generate the table of type sets used by runtime typechecks, as 256-bit bitmaps indexed by
+/// `ir::Type::index()`, along with the `ts_contains` helper that tests membership.
+fn gen_typesets_table(type_sets: &UniqueTable<TypeSet>, fmt: &mut Formatter) {
+    if type_sets.len() == 0 {
+        return;
+    }
+
+    fmt.line("#[inline(always)]");
+    fmt.line("fn ts_contains(ts: &[u64; 4], t: ir::Type) -> bool {");
+    fmt.indent(|fmt| {
+        fmt.line("let i = t.index();");
+        fmt.line("(ts[i >> 6] >> (i & 63)) & 1 != 0");
+    });
+    fmt.line("}");
+    fmt.empty_line();
+
+    fmt.comment("Table of value type sets.");
+    fmtln!(fmt, "const TYPE_SETS: [[u64; 4]; {}] = [", type_sets.len());
+    fmt.indent(|fmt| {
+        for ts in type_sets.iter() {
+            let mut words = [0u64; 4];
+            for ty in ts.concrete_types() {
+                let number = ty.number().expect("type sets only hold numbered types") as usize;
+                words[number >> 6] |= 1 << (number & 63);
+            }
+            fmt.comment(format!("{:?}", ts));
+            fmtln!(
+                fmt,
+                "[{:#018x}, {:#018x}, {:#018x}, {:#018x}],",
+                words[0],
+                words[1],
+                words[2],
+                words[3]
+            );
+        }
+    });
+    fmtln!(fmt, "];");
+}
+
+/// Generate legalization functions for `isa`, and return the names of the shared
+/// `TransformGroup`s it uses.
 ///
 /// Generate `TYPE_SETS` and `LEGALIZE_ACTIONS` tables.
+///
+/// This doesn't depend on any other ISA, so each ISA's file can be generated independently; only
+/// the shared groups need to be merged afterwards.
 fn gen_isa(
     isa: &TargetIsa,
     transform_groups: &TransformGroups,
-    shared_group_names: &mut HashSet<&'static str>,
     fmt: &mut Formatter,
-) {
-    let mut type_sets = UniqueTable::new();
+) -> HashSet<&'static str> {
+    let mut shared_group_names = HashSet::new();
+    let mut isa_groups = Vec::new();
     for group_index in isa.transitive_transform_groups(transform_groups) {
         let group = transform_groups.get(group_index);
         match group.isa_name {
@@ -672,7 +824,7 @@ fn gen_isa(
                     isa_name == isa.name,
                     "ISA-specific legalizations must be used by the same ISA"
                 );
-                gen_transform_group(group, transform_groups, &mut type_sets, fmt);
+                isa_groups.push(group);
             }
             None => {
                 shared_group_names.insert(group.name);
@@ -680,6 +832,13 @@ fn gen_isa(
         }
     }
 
+    let mut type_sets = UniqueTable::new();
+    let typechecks = RuntimeTypechecks::collect(&isa_groups, &mut type_sets);
+    for (i, group) in isa_groups.into_iter().enumerate() {
+        gen_transform_group(group, transform_groups, typechecks.group_checks(i), fmt);
+    }
+
+    typechecks.gen_helpers(fmt);
     gen_typesets_table(&type_sets, fmt);
 
     let direct_groups = isa.direct_transform_groups();
@@ -694,6 +853,8 @@ fn gen_isa(
         }
     });
     fmtln!(fmt, "];");
+
+    shared_group_names
 }
 
 /// Generate the legalizer files.
@@ -708,7 +869,7 @@ pub(crate) fn generate(
 
     for isa in isas {
         let mut fmt = Formatter::new();
-        gen_isa(isa, transform_groups, &mut shared_group_names, &mut fmt);
+        shared_group_names.extend(gen_isa(isa, transform_groups, &mut fmt));
         fmt.update_file(format!("{}-{}.rs", filename_prefix, isa.name), out_dir)?;
     }
 
@@ -723,10 +884,20 @@ pub(crate) fn generate(
     let mut type_sets = UniqueTable::new();
     let mut sorted_shared_group_names = Vec::from_iter(shared_group_names);
     sorted_shared_group_names.sort();
-    for group_name in &sorted_shared_group_names {
-        let group = transform_groups.by_name(group_name);
-        gen_transform_group(group, transform_groups, &mut type_sets, &mut fmt);
+    let shared_groups = sorted_shared_group_names
+        .iter()
+        .map(|group_name| transform_groups.by_name(group_name))
+        .collect::<Vec<_>>();
+    let typechecks = RuntimeTypechecks::collect(&shared_groups, &mut type_sets);
+    for (i, group) in shared_groups.into_iter().enumerate() {
+        gen_transform_group(
+            group,
+            transform_groups,
+            typechecks.group_checks(i),
+            &mut fmt,
+        );
     }
+    typechecks.gen_helpers(&mut fmt);
     gen_typesets_table(&type_sets, &mut fmt);
     fmt.update_file(format!("{}r.rs", filename_prefix), out_dir)?;
 
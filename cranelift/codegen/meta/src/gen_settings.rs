@@ -1,14 +1,14 @@
 //! Generate the ISA-specific settings.
 use std::collections::HashMap;
 
-use cranelift_codegen_shared::constant_hash::{generate_table, simple_hash};
+use cranelift_codegen_shared::constant_hash::{generate_table_with_size, simple_hash};
 
 use crate::cdsl::camel_case;
 use crate::cdsl::settings::{
     BoolSetting, Predicate, Preset, Setting, SettingGroup, SpecificSetting,
 };
 use crate::error;
-use crate::srcgen::{Formatter, Match};
+use crate::srcgen::Formatter;
 use crate::unique_table::UniqueSeqTable;
 
 pub(crate) enum ParentGroup {
@@ -47,20 +47,46 @@ fn gen_constructor(group: &SettingGroup, parent: ParentGroup, fmt: &mut Formatte
                 group.settings_size
             );
 
-            // Now compute the predicates.
-            for p in &group.predicates {
-                fmt.comment(format!("Precompute #{}.", p.number));
-                fmtln!(fmt, "if {} {{", p.render(group));
+            // Now compute the predicates. Predicates only depend on settings, so all the
+            // predicates sharing a byte are combined into a single update of that byte.
+            let mut predicates = group.predicates.iter().peekable();
+            while let Some(first) = predicates.next() {
+                let byte = first.number / 8;
+                let mut terms = vec![(first.number, first.render(group))];
+                while let Some(p) = predicates.peek() {
+                    if p.number / 8 != byte {
+                        break;
+                    }
+                    terms.push((p.number, p.render(group)));
+                    predicates.next();
+                }
+
+                let last_number = terms.last().unwrap().0;
+                if last_number == first.number {
+                    fmt.comment(format!("Precompute #{}.", first.number));
+                } else {
+                    fmt.comment(format!("Precompute #{} to #{}.", first.number, last_number));
+                }
+                let mut terms = terms
+                    .iter()
+                    .map(|(number, cond)| match number % 8 {
+                        0 => format!("(({}) as u8)", cond),
+                        bit => format!("(({}) as u8) << {}", cond, bit),
+                    })
+                    .collect::<Vec<_>>();
+                terms.last_mut().unwrap().push(';');
+                fmtln!(
+                    fmt,
+                    "{}.bytes[{}] |= {}",
+                    group.name,
+                    group.bool_start_byte_offset + byte,
+                    terms[0]
+                );
                 fmt.indent(|fmt| {
-                    fmtln!(
-                        fmt,
-                        "{}.bytes[{}] |= 1 << {};",
-                        group.name,
-                        group.bool_start_byte_offset + p.number / 8,
-                        p.number % 8
-                    );
+                    for term in &terms[1..] {
+                        fmtln!(fmt, "| {}", term);
+                    }
                 });
-                fmtln!(fmt, "}");
             }
 
             fmtln!(fmt, group.name);
@@ -98,7 +124,14 @@ fn gen_iterator(group: &SettingGroup, fmt: &mut Formatter) {
 }
 
 /// Emit Display and FromStr implementations for enum settings.
-fn gen_to_and_from_str(name: &str, values: &[&'static str], fmt: &mut Formatter) {
+///
+/// `variants` holds the enum variant name of each of the `values`.
+fn gen_to_and_from_str(
+    name: &str,
+    values: &[&'static str],
+    variants: &[String],
+    fmt: &mut Formatter,
+) {
     fmtln!(fmt, "impl fmt::Display for {} {{", name);
     fmt.indent(|fmt| {
         fmtln!(
@@ -108,8 +141,8 @@ fn gen_to_and_from_str(name: &str, values: &[&'static str], fmt: &mut Formatter)
         fmt.indent(|fmt| {
             fmtln!(fmt, "f.write_str(match *self {");
             fmt.indent(|fmt| {
-                for v in values.iter() {
-                    fmtln!(fmt, "Self::{} => \"{}\",", camel_case(v), v);
+                for (v, variant) in values.iter().zip(variants) {
+                    fmtln!(fmt, "Self::{} => \"{}\",", variant, v);
                 }
             });
             fmtln!(fmt, "})");
@@ -125,8 +158,8 @@ fn gen_to_and_from_str(name: &str, values: &[&'static str], fmt: &mut Formatter)
         fmt.indent(|fmt| {
             fmtln!(fmt, "match s {");
             fmt.indent(|fmt| {
-                for v in values.iter() {
-                    fmtln!(fmt, "\"{}\" => Ok(Self::{}),", v, camel_case(v));
+                for (v, variant) in values.iter().zip(variants) {
+                    fmtln!(fmt, "\"{}\" => Ok(Self::{}),", v, variant);
                 }
                 fmtln!(fmt, "_ => Err(()),");
             });
@@ -145,24 +178,35 @@ fn gen_enum_types(group: &SettingGroup, fmt: &mut Formatter) {
             SpecificSetting::Enum(ref values) => values,
         };
         let name = camel_case(setting.name);
+        let variants = values.iter().map(|v| camel_case(v)).collect::<Vec<_>>();
 
         fmt.doc_comment(format!("Values for `{}.{}`.", group.name, setting.name));
         fmtln!(fmt, "#[derive(Debug, Copy, Clone, PartialEq, Eq, Hash)]");
         fmtln!(fmt, "pub enum {} {{", name);
         fmt.indent(|fmt| {
-            for v in values.iter() {
+            for (v, variant) in values.iter().zip(&variants) {
                 fmt.doc_comment(format!("`{}`.", v));
-                fmtln!(fmt, "{},", camel_case(v));
+                fmtln!(fmt, "{},", variant);
             }
         });
         fmtln!(fmt, "}");
 
-        gen_to_and_from_str(&name, values, fmt);
+        gen_to_and_from_str(&name, values, &variants, fmt);
     }
 }
 
+/// Emit the test of numbered predicate `number`, with its byte and bit resolved here.
+fn gen_predicate_test(group: &SettingGroup, number: u8, fmt: &mut Formatter) {
+    fmtln!(
+        fmt,
+        "self.bytes[{}] & {:#010b} != 0",
+        group.bool_start_byte_offset + number / 8,
+        1u8 << (number % 8)
+    );
+}
+
 /// Emit a getter function for `setting`.
-fn gen_getter(setting: &Setting, fmt: &mut Formatter) {
+fn gen_getter(setting: &Setting, group: &SettingGroup, fmt: &mut Formatter) {
     fmt.doc_comment(format!("{}\n{}", setting.description, setting.comment));
     match setting.specific {
         SpecificSetting::Bool(BoolSetting {
@@ -170,7 +214,7 @@ fn gen_getter(setting: &Setting, fmt: &mut Formatter) {
         }) => {
             fmtln!(fmt, "pub fn {}(&self) -> bool {{", setting.name);
             fmt.indent(|fmt| {
-                fmtln!(fmt, "self.numbered_predicate({})", predicate_number);
+                gen_predicate_test(group, predicate_number, fmt);
             });
             fmtln!(fmt, "}");
         }
@@ -178,12 +222,16 @@ fn gen_getter(setting: &Setting, fmt: &mut Formatter) {
             let ty = camel_case(setting.name);
             fmtln!(fmt, "pub fn {}(&self) -> {} {{", setting.name, ty);
             fmt.indent(|fmt| {
-                let mut m = Match::new(format!("self.bytes[{}]", setting.byte_offset));
-                for (i, v) in values.iter().enumerate() {
-                    m.arm_no_fields(format!("{}", i), format!("{}::{}", ty, camel_case(v)));
-                }
-                m.arm_no_fields("_", "panic!(\"Invalid enum value\")");
-                fmt.add_match(m);
+                // The stored byte is the index of the value, so look it up in a table of all the
+                // values rather than matching on it.
+                fmtln!(fmt, "const VALUES: [{}; {}] = [", ty, values.len());
+                fmt.indent(|fmt| {
+                    for v in values {
+                        fmtln!(fmt, "{}::{},", ty, camel_case(v));
+                    }
+                });
+                fmtln!(fmt, "];");
+                fmtln!(fmt, "VALUES[self.bytes[{}] as usize]", setting.byte_offset);
             });
             fmtln!(fmt, "}");
         }
@@ -201,7 +249,7 @@ fn gen_pred_getter(predicate: &Predicate, group: &SettingGroup, fmt: &mut Format
     fmt.doc_comment(format!("Computed predicate `{}`.", predicate.render(group)));
     fmtln!(fmt, "pub fn {}(&self) -> bool {{", predicate.name);
     fmt.indent(|fmt| {
-        fmtln!(fmt, "self.numbered_predicate({})", predicate.number);
+        gen_predicate_test(group, predicate.number, fmt);
     });
     fmtln!(fmt, "}");
 }
@@ -226,21 +274,8 @@ fn gen_getters(group: &SettingGroup, fmt: &mut Formatter) {
         });
         fmtln!(fmt, "}");
 
-        if !group.settings.is_empty() {
-            fmt.doc_comment("Dynamic numbered predicate getter.");
-            fmtln!(fmt, "fn numbered_predicate(&self, p: usize) -> bool {");
-            fmt.indent(|fmt| {
-                fmtln!(
-                    fmt,
-                    "self.bytes[{} + p / 8] & (1 << (p % 8)) != 0",
-                    group.bool_start_byte_offset
-                );
-            });
-            fmtln!(fmt, "}");
-        }
-
         for setting in &group.settings {
-            gen_getter(&setting, fmt);
+            gen_getter(&setting, &group, fmt);
         }
         for predicate in &group.predicates {
             gen_pred_getter(&predicate, &group, fmt);
@@ -264,6 +299,18 @@ impl<'a> SettingOrPreset<'a> {
     }
 }
 
+/// Emit a single entry of the DESCRIPTORS table.
+fn gen_descriptor(name: &str, description: &str, offset: u8, detail: &str, fmt: &mut Formatter) {
+    fmtln!(fmt, "detail::Descriptor {");
+    fmt.indent(|fmt| {
+        fmtln!(fmt, "name: \"{}\",", name);
+        fmtln!(fmt, "description: \"{}\",", description);
+        fmtln!(fmt, "offset: {},", offset);
+        fmtln!(fmt, "detail: {},", detail);
+    });
+    fmtln!(fmt, "},");
+}
+
 /// Emits DESCRIPTORS, ENUMERATORS, HASH_TABLE and PRESETS.
 fn gen_descriptors(group: &SettingGroup, fmt: &mut Formatter) {
     let mut enum_table = UniqueSeqTable::new();
@@ -278,47 +325,39 @@ fn gen_descriptors(group: &SettingGroup, fmt: &mut Formatter) {
     );
     fmt.indent(|fmt| {
         for (idx, setting) in group.settings.iter().enumerate() {
-            fmtln!(fmt, "detail::Descriptor {");
-            fmt.indent(|fmt| {
-                fmtln!(fmt, "name: \"{}\",", setting.name);
-                fmtln!(fmt, "description: \"{}\",", setting.description);
-                fmtln!(fmt, "offset: {},", setting.byte_offset);
-                match setting.specific {
-                    SpecificSetting::Bool(BoolSetting { bit_offset, .. }) => {
-                        fmtln!(
-                            fmt,
-                            "detail: detail::Detail::Bool {{ bit: {} }},",
-                            bit_offset
-                        );
-                    }
-                    SpecificSetting::Enum(ref values) => {
-                        let offset = enum_table.add(values);
-                        fmtln!(
-                            fmt,
-                            "detail: detail::Detail::Enum {{ last: {}, enumerators: {} }},",
-                            values.len() - 1,
-                            offset
-                        );
-                    }
-                    SpecificSetting::Num(_) => {
-                        fmtln!(fmt, "detail: detail::Detail::Num,");
-                    }
+            let detail = match setting.specific {
+                SpecificSetting::Bool(BoolSetting { bit_offset, .. }) => {
+                    format!("detail::Detail::Bool {{ bit: {} }}", bit_offset)
                 }
+                SpecificSetting::Enum(ref values) => {
+                    let offset = enum_table.add(values);
+                    format!(
+                        "detail::Detail::Enum {{ last: {}, enumerators: {} }}",
+                        values.len() - 1,
+                        offset
+                    )
+                }
+                SpecificSetting::Num(_) => "detail::Detail::Num".to_string(),
+            };
+            gen_descriptor(
+                setting.name,
+                setting.description,
+                setting.byte_offset,
+                &detail,
+                fmt,
+            );
 
-                descriptor_index_map.insert(SettingOrPreset::Setting(setting), idx);
-            });
-            fmtln!(fmt, "},");
+            descriptor_index_map.insert(SettingOrPreset::Setting(setting), idx);
         }
 
         for (idx, preset) in group.presets.iter().enumerate() {
-            fmtln!(fmt, "detail::Descriptor {");
-            fmt.indent(|fmt| {
-                fmtln!(fmt, "name: \"{}\",", preset.name);
-                fmtln!(fmt, "description: \"{}\",", preset.description);
-                fmtln!(fmt, "offset: {},", (idx as u8) * group.settings_size);
-                fmtln!(fmt, "detail: detail::Detail::Preset,");
-            });
-            fmtln!(fmt, "},");
+            gen_descriptor(
+                preset.name,
+                preset.description,
+                (idx as u8) * group.settings_size,
+                "detail::Detail::Preset",
+                fmt,
+            );
 
             let whole_idx = idx + group.settings.len();
             descriptor_index_map.insert(SettingOrPreset::Preset(preset), whole_idx);
@@ -326,7 +365,8 @@ fn gen_descriptors(group: &SettingGroup, fmt: &mut Formatter) {
     });
     fmtln!(fmt, "];");
 
-    // Generate enumerators.
+    // Generate enumerators. These stay a table of `&str` rather than a packed byte string: the
+    // public `settings::Value::values` hands out slices of this table directly.
     fmtln!(fmt, "static ENUMERATORS: [&str; {}] = [", enum_table.len());
     fmt.indent(|fmt| {
         for enum_val in enum_table.iter() {
@@ -340,9 +380,16 @@ fn gen_descriptors(group: &SettingGroup, fmt: &mut Formatter) {
     hash_entries.extend(group.settings.iter().map(|x| SettingOrPreset::Setting(x)));
     hash_entries.extend(group.presets.iter().map(|x| SettingOrPreset::Preset(x)));
 
-    let hash_table = generate_table(hash_entries.iter(), hash_entries.len(), |entry| {
-        simple_hash(entry.name())
-    });
+    // Keep the load factor at or below one half: lookups of unknown setting names are common, and
+    // they have to probe until they hit a vacant slot.
+    //
+    // The size is a power of two, so `constant_hash::probe` derives its mask from the slice length
+    // once per lookup; there's no need to emit the mask separately.
+    let hash_table = generate_table_with_size(
+        hash_entries.iter(),
+        (2 * hash_entries.len()).next_power_of_two(),
+        |entry| simple_hash(entry.name()),
+    );
     fmtln!(fmt, "static HASH_TABLE: [u16; {}] = [", hash_table.len());
     fmt.indent(|fmt| {
         for h in &hash_table {
@@ -379,12 +426,8 @@ fn gen_descriptors(group: &SettingGroup, fmt: &mut Formatter) {
 }
 
 fn gen_template(group: &SettingGroup, fmt: &mut Formatter) {
-    let mut default_bytes: Vec<u8> = vec![0; group.settings_size as usize];
-    for setting in &group.settings {
-        *default_bytes.get_mut(setting.byte_offset as usize).unwrap() |= setting.default_byte();
-    }
-
-    let default_bytes: Vec<String> = default_bytes
+    let default_bytes: Vec<String> = group
+        .default_bytes
         .iter()
         .map(|x| format!("{:#04x}", x))
         .collect();
@@ -424,20 +467,36 @@ fn gen_display(group: &SettingGroup, fmt: &mut Formatter) {
         );
         fmt.indent(|fmt| {
             fmtln!(fmt, "writeln!(f, \"[{}]\")?;", group.name);
-            fmtln!(fmt, "for d in &DESCRIPTORS {");
-            fmt.indent(|fmt| {
-                fmtln!(fmt, "if !d.detail.is_preset() {");
-                fmt.indent(|fmt| {
-                    fmtln!(fmt, "write!(f, \"{} = \", d.name)?;");
-                    fmtln!(
-                        fmt,
-                        "TEMPLATE.format_toml_value(d.detail, self.bytes[d.offset as usize], f)?;",
-                    );
-                    fmtln!(fmt, "writeln!(f)?;");
-                });
-                fmtln!(fmt, "}");
-            });
-            fmtln!(fmt, "}");
+            // The settings are known here, so write each of them directly rather than walking
+            // `DESCRIPTORS` at runtime. Presets aren't printed, as they are reflected in the other
+            // settings.
+            for (idx, setting) in group.settings.iter().enumerate() {
+                let byte = format!("self.bytes[{}]", setting.byte_offset);
+                match setting.specific {
+                    SpecificSetting::Bool(BoolSetting { bit_offset, .. }) => {
+                        fmtln!(
+                            fmt,
+                            "writeln!(f, \"{} = {{}}\", ({} & (1 << {})) != 0)?;",
+                            setting.name,
+                            byte,
+                            bit_offset
+                        );
+                    }
+                    SpecificSetting::Enum(_) => {
+                        fmtln!(fmt, "f.write_str(\"{} = \")?;", setting.name);
+                        fmtln!(
+                            fmt,
+                            "TEMPLATE.format_toml_value(DESCRIPTORS[{}].detail, {}, f)?;",
+                            idx,
+                            byte
+                        );
+                        fmtln!(fmt, "writeln!(f)?;");
+                    }
+                    SpecificSetting::Num(_) => {
+                        fmtln!(fmt, "writeln!(f, \"{} = {{}}\", {})?;", setting.name, byte);
+                    }
+                }
+            }
             fmtln!(fmt, "Ok(())");
         });
         fmtln!(fmt, "}")
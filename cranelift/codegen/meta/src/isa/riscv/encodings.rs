@@ -46,6 +46,16 @@ impl<'defs> PerCpuModeEncodings<'defs> {
         self.enc64
             .push(encoding.build(self.recipes, &mut self.inst_pred_reg));
     }
+    /// Add the same encoding to both the RV32 and RV64 modes.
+    fn add_both(
+        &mut self,
+        inst: impl Clone + Into<InstSpec>,
+        recipe: EncodingRecipeNumber,
+        bits: u16,
+    ) {
+        self.add32(self.enc(inst.clone(), recipe, bits));
+        self.add64(self.enc(inst, recipe, bits));
+    }
 }
 
 // The low 7 bits of a RISC-V instruction is the base opcode. All 32-bit instructions have 11 as
@@ -54,55 +64,64 @@ impl<'defs> PerCpuModeEncodings<'defs> {
 // Encbits for the 32-bit recipes are opcode[6:2] | (funct3 << 5) | ...
 // The functions below encode the encbits.
 
-fn load_bits(funct3: u16) -> u16 {
+// Base opcodes, i.e. bits 6:2 of the instruction.
+const OPCODE_LOAD: u16 = 0b00000;
+const OPCODE_STORE: u16 = 0b01000;
+const OPCODE_BRANCH: u16 = 0b11000;
+const OPCODE_JALR: u16 = 0b11001;
+const OPCODE_JAL: u16 = 0b11011;
+const OPCODE_OP_IMM: u16 = 0b00100;
+const OPCODE_OP_IMM_32: u16 = 0b00110;
+const OPCODE_OP: u16 = 0b01100;
+const OPCODE_OP_32: u16 = 0b01110;
+const OPCODE_LUI: u16 = 0b01101;
+
+fn encbits(opcode: u16, funct3: u16, funct7: u16) -> u16 {
     assert!(funct3 <= 0b111);
-    funct3 << 5
+    assert!(funct7 <= 0b111_1111);
+    opcode | (funct3 << 5) | (funct7 << 8)
+}
+
+fn load_bits(funct3: u16) -> u16 {
+    encbits(OPCODE_LOAD, funct3, 0)
 }
 
 fn store_bits(funct3: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    0b01000 | (funct3 << 5)
+    encbits(OPCODE_STORE, funct3, 0)
 }
 
 fn branch_bits(funct3: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    0b11000 | (funct3 << 5)
+    encbits(OPCODE_BRANCH, funct3, 0)
 }
 
 fn jalr_bits() -> u16 {
     // This was previously accepting an argument funct3 of 3 bits and used the following formula:
     //0b11001 | (funct3 << 5)
-    0b11001
+    OPCODE_JALR
 }
 
 fn jal_bits() -> u16 {
-    0b11011
+    OPCODE_JAL
 }
 
 fn opimm_bits(funct3: u16, funct7: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    0b00100 | (funct3 << 5) | (funct7 << 8)
+    encbits(OPCODE_OP_IMM, funct3, funct7)
 }
 
 fn opimm32_bits(funct3: u16, funct7: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    0b00110 | (funct3 << 5) | (funct7 << 8)
+    encbits(OPCODE_OP_IMM_32, funct3, funct7)
 }
 
 fn op_bits(funct3: u16, funct7: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    assert!(funct7 <= 0b111_1111);
-    0b01100 | (funct3 << 5) | (funct7 << 8)
+    encbits(OPCODE_OP, funct3, funct7)
 }
 
 fn op32_bits(funct3: u16, funct7: u16) -> u16 {
-    assert!(funct3 <= 0b111);
-    assert!(funct7 <= 0b111_1111);
-    0b01110 | (funct3 << 5) | (funct7 << 8)
+    encbits(OPCODE_OP_32, funct3, funct7)
 }
 
 fn lui_bits() -> u16 {
-    0b01101
+    OPCODE_LUI
 }
 
 pub(crate) fn define<'defs>(
@@ -200,8 +219,7 @@ pub(crate) fn define<'defs>(
     e.add64(e.enc(iadd_imm.bind(I32), r_ii, opimm32_bits(0b000, 0)));
 
     // Use iadd_imm with %x0 to materialize constants.
-    e.add32(e.enc(iconst.bind(I32), r_iz, opimm_bits(0b0, 0)));
-    e.add64(e.enc(iconst.bind(I32), r_iz, opimm_bits(0b0, 0)));
+    e.add_both(iconst.bind(I32), r_iz, opimm_bits(0b0, 0));
     e.add64(e.enc(iconst.bind(I64), r_iz, opimm_bits(0b0, 0)));
 
     // Dynamic shifts have the same masking semantics as the clif base instructions.
@@ -286,8 +304,7 @@ pub(crate) fn define<'defs>(
     }
 
     // Integer constants with the low 12 bits clear are materialized by lui.
-    e.add32(e.enc(iconst.bind(I32), r_u, lui_bits()));
-    e.add64(e.enc(iconst.bind(I32), r_u, lui_bits()));
+    e.add_both(iconst.bind(I32), r_u, lui_bits());
     e.add64(e.enc(iconst.bind(I64), r_u, lui_bits()));
 
     // "M" Standard Extension for Integer Multiplication and Division.
@@ -308,10 +325,8 @@ pub(crate) fn define<'defs>(
     // Control flow.
 
     // Unconditional branches.
-    e.add32(e.enc(jump, r_uj, jal_bits()));
-    e.add64(e.enc(jump, r_uj, jal_bits()));
-    e.add32(e.enc(call, r_uj_call, jal_bits()));
-    e.add64(e.enc(call, r_uj_call, jal_bits()));
+    e.add_both(jump, r_uj, jal_bits());
+    e.add_both(call, r_uj_call, jal_bits());
 
     // Conditional branches.
     {
@@ -364,33 +379,27 @@ pub(crate) fn define<'defs>(
     for &(inst, f3) in &[(brz, 0b000), (brnz, 0b001)] {
         e.add32(e.enc(inst.bind(I32), r_sb_zero, branch_bits(f3)));
         e.add64(e.enc(inst.bind(I64), r_sb_zero, branch_bits(f3)));
-        e.add32(e.enc(inst.bind(B1), r_sb_zero, branch_bits(f3)));
-        e.add64(e.enc(inst.bind(B1), r_sb_zero, branch_bits(f3)));
+        e.add_both(inst.bind(B1), r_sb_zero, branch_bits(f3));
     }
 
     // Returns are a special case of jalr_bits using %x1 to hold the return address.
     // The return address is provided by a special-purpose `link` return value that
     // is added by legalize_signature().
-    e.add32(e.enc(return_, r_iret, jalr_bits()));
-    e.add64(e.enc(return_, r_iret, jalr_bits()));
+    e.add_both(return_, r_iret, jalr_bits());
     e.add32(e.enc(call_indirect.bind(I32), r_icall, jalr_bits()));
     e.add64(e.enc(call_indirect.bind(I64), r_icall, jalr_bits()));
 
     // Spill and fill.
-    e.add32(e.enc(spill.bind(I32), r_gp_sp, store_bits(0b010)));
-    e.add64(e.enc(spill.bind(I32), r_gp_sp, store_bits(0b010)));
+    e.add_both(spill.bind(I32), r_gp_sp, store_bits(0b010));
     e.add64(e.enc(spill.bind(I64), r_gp_sp, store_bits(0b011)));
-    e.add32(e.enc(fill.bind(I32), r_gp_fi, load_bits(0b010)));
-    e.add64(e.enc(fill.bind(I32), r_gp_fi, load_bits(0b010)));
+    e.add_both(fill.bind(I32), r_gp_fi, load_bits(0b010));
     e.add64(e.enc(fill.bind(I64), r_gp_fi, load_bits(0b011)));
 
     // No-op fills, created by late-stage redundant-fill removal.
     for &ty in &[I64, I32] {
-        e.add64(e.enc(fill_nop.bind(ty), r_fillnull, 0));
-        e.add32(e.enc(fill_nop.bind(ty), r_fillnull, 0));
+        e.add_both(fill_nop.bind(ty), r_fillnull, 0);
     }
-    e.add64(e.enc(fill_nop.bind(B1), r_fillnull, 0));
-    e.add32(e.enc(fill_nop.bind(B1), r_fillnull, 0));
+    e.add_both(fill_nop.bind(B1), r_fillnull, 0);
 
     // Register copies.
     e.add32(e.enc(copy.bind(I32), r_icopy, opimm_bits(0b000, 0)));
@@ -401,29 +410,24 @@ pub(crate) fn define<'defs>(
     e.add64(e.enc(regmove.bind(I64), r_irmov, opimm_bits(0b000, 0)));
     e.add64(e.enc(regmove.bind(I32), r_irmov, opimm32_bits(0b000, 0)));
 
-    e.add32(e.enc(copy.bind(B1), r_icopy, opimm_bits(0b000, 0)));
-    e.add64(e.enc(copy.bind(B1), r_icopy, opimm_bits(0b000, 0)));
-    e.add32(e.enc(regmove.bind(B1), r_irmov, opimm_bits(0b000, 0)));
-    e.add64(e.enc(regmove.bind(B1), r_irmov, opimm_bits(0b000, 0)));
+    e.add_both(copy.bind(B1), r_icopy, opimm_bits(0b000, 0));
+    e.add_both(regmove.bind(B1), r_irmov, opimm_bits(0b000, 0));
 
     // Stack-slot-to-the-same-stack-slot copy, which is guaranteed to turn
     // into a no-op.
     // The same encoding is generated for both the 64- and 32-bit architectures.
     for &ty in &[I64, I32, I16, I8] {
-        e.add32(e.enc(copy_nop.bind(ty), r_stacknull, 0));
-        e.add64(e.enc(copy_nop.bind(ty), r_stacknull, 0));
+        e.add_both(copy_nop.bind(ty), r_stacknull, 0);
     }
     for &ty in &[F64, F32] {
-        e.add32(e.enc(copy_nop.bind(ty), r_stacknull, 0));
-        e.add64(e.enc(copy_nop.bind(ty), r_stacknull, 0));
+        e.add_both(copy_nop.bind(ty), r_stacknull, 0);
     }
 
     // Copy-to-SSA
     e.add32(e.enc(copy_to_ssa.bind(I32), r_copytossa, opimm_bits(0b000, 0)));
     e.add64(e.enc(copy_to_ssa.bind(I64), r_copytossa, opimm_bits(0b000, 0)));
     e.add64(e.enc(copy_to_ssa.bind(I32), r_copytossa, opimm32_bits(0b000, 0)));
-    e.add32(e.enc(copy_to_ssa.bind(B1), r_copytossa, opimm_bits(0b000, 0)));
-    e.add64(e.enc(copy_to_ssa.bind(B1), r_copytossa, opimm_bits(0b000, 0)));
+    e.add_both(copy_to_ssa.bind(B1), r_copytossa, opimm_bits(0b000, 0));
     e.add32(e.enc(copy_to_ssa.bind(R32), r_copytossa, opimm_bits(0b000, 0)));
     e.add64(e.enc(copy_to_ssa.bind(R64), r_copytossa, opimm_bits(0b000, 0)));
 
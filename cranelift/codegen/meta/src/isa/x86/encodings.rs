@@ -26,6 +26,8 @@ pub(crate) struct PerCpuModeEncodings {
     pub enc32: Vec<Encoding>,
     pub enc64: Vec<Encoding>,
     pub recipes: Recipes,
+    /// Index into `recipes` shared by all templates, so that a recipe specialized the same way
+    /// by several encodings is only stored once.
     recipes_by_name: HashMap<String, EncodingRecipeNumber>,
     pub inst_pred_reg: InstructionPredicateRegistry,
 }
@@ -1145,9 +1147,9 @@ fn define_fpu_memory(
     let rec_fstWithIndexDisp8 = r.template("fstWithIndexDisp8");
 
     // Float loads and stores.
-    e.enc_both(load.bind(F32).bind(Any), rec_fld.opcodes(&MOVSS_LOAD));
-    e.enc_both(load.bind(F32).bind(Any), rec_fldDisp8.opcodes(&MOVSS_LOAD));
-    e.enc_both(load.bind(F32).bind(Any), rec_fldDisp32.opcodes(&MOVSS_LOAD));
+    e.enc_both_inferred(load.bind(F32).bind(Any), rec_fld.opcodes(&MOVSS_LOAD));
+    e.enc_both_inferred(load.bind(F32).bind(Any), rec_fldDisp8.opcodes(&MOVSS_LOAD));
+    e.enc_both_inferred(load.bind(F32).bind(Any), rec_fldDisp32.opcodes(&MOVSS_LOAD));
 
     e.enc_both(
         load_complex.bind(F32),
@@ -1162,9 +1164,9 @@ fn define_fpu_memory(
         rec_fldWithIndexDisp32.opcodes(&MOVSS_LOAD),
     );
 
-    e.enc_both(load.bind(F64).bind(Any), rec_fld.opcodes(&MOVSD_LOAD));
-    e.enc_both(load.bind(F64).bind(Any), rec_fldDisp8.opcodes(&MOVSD_LOAD));
-    e.enc_both(load.bind(F64).bind(Any), rec_fldDisp32.opcodes(&MOVSD_LOAD));
+    e.enc_both_inferred(load.bind(F64).bind(Any), rec_fld.opcodes(&MOVSD_LOAD));
+    e.enc_both_inferred(load.bind(F64).bind(Any), rec_fldDisp8.opcodes(&MOVSD_LOAD));
+    e.enc_both_inferred(load.bind(F64).bind(Any), rec_fldDisp32.opcodes(&MOVSD_LOAD));
 
     e.enc_both(
         load_complex.bind(F64),
@@ -1179,12 +1181,12 @@ fn define_fpu_memory(
         rec_fldWithIndexDisp32.opcodes(&MOVSD_LOAD),
     );
 
-    e.enc_both(store.bind(F32).bind(Any), rec_fst.opcodes(&MOVSS_STORE));
-    e.enc_both(
+    e.enc_both_inferred(store.bind(F32).bind(Any), rec_fst.opcodes(&MOVSS_STORE));
+    e.enc_both_inferred(
         store.bind(F32).bind(Any),
         rec_fstDisp8.opcodes(&MOVSS_STORE),
     );
-    e.enc_both(
+    e.enc_both_inferred(
         store.bind(F32).bind(Any),
         rec_fstDisp32.opcodes(&MOVSS_STORE),
     );
@@ -1202,12 +1204,12 @@ fn define_fpu_memory(
         rec_fstWithIndexDisp32.opcodes(&MOVSS_STORE),
     );
 
-    e.enc_both(store.bind(F64).bind(Any), rec_fst.opcodes(&MOVSD_STORE));
-    e.enc_both(
+    e.enc_both_inferred(store.bind(F64).bind(Any), rec_fst.opcodes(&MOVSD_STORE));
+    e.enc_both_inferred(
         store.bind(F64).bind(Any),
         rec_fstDisp8.opcodes(&MOVSD_STORE),
     );
-    e.enc_both(
+    e.enc_both_inferred(
         store.bind(F64).bind(Any),
         rec_fstDisp32.opcodes(&MOVSD_STORE),
     );
@@ -1225,14 +1227,14 @@ fn define_fpu_memory(
         rec_fstWithIndexDisp32.opcodes(&MOVSD_STORE),
     );
 
-    e.enc_both(fill.bind(F32), rec_ffillSib32.opcodes(&MOVSS_LOAD));
+    e.enc_both_inferred(fill.bind(F32), rec_ffillSib32.opcodes(&MOVSS_LOAD));
     e.enc_both(regfill.bind(F32), rec_fregfill32.opcodes(&MOVSS_LOAD));
-    e.enc_both(fill.bind(F64), rec_ffillSib32.opcodes(&MOVSD_LOAD));
+    e.enc_both_inferred(fill.bind(F64), rec_ffillSib32.opcodes(&MOVSD_LOAD));
     e.enc_both(regfill.bind(F64), rec_fregfill32.opcodes(&MOVSD_LOAD));
 
-    e.enc_both(spill.bind(F32), rec_fspillSib32.opcodes(&MOVSS_STORE));
+    e.enc_both_inferred(spill.bind(F32), rec_fspillSib32.opcodes(&MOVSS_STORE));
     e.enc_both(regspill.bind(F32), rec_fregspill32.opcodes(&MOVSS_STORE));
-    e.enc_both(spill.bind(F64), rec_fspillSib32.opcodes(&MOVSD_STORE));
+    e.enc_both_inferred(spill.bind(F64), rec_fspillSib32.opcodes(&MOVSD_STORE));
     e.enc_both(regspill.bind(F64), rec_fregspill32.opcodes(&MOVSD_STORE));
 }
 
@@ -1429,6 +1431,7 @@ fn define_alu(
     let use_popcnt = settings.predicate_by_name("use_popcnt");
     let use_lzcnt = settings.predicate_by_name("use_lzcnt");
     let use_bmi1 = settings.predicate_by_name("use_bmi1");
+    let use_bmi2 = settings.predicate_by_name("use_bmi2");
 
     let band = shared.by_name("band");
     let band_imm = shared.by_name("band_imm");
@@ -1457,6 +1460,7 @@ fn define_alu(
     let rec_fa = r.template("fa");
     let rec_fax = r.template("fax");
     let rec_mulx = r.template("mulx");
+    let rec_mulx_vex = r.template("mulx_vex");
     let rec_r_ib = r.template("r_ib");
     let rec_r_id = r.template("r_id");
     let rec_rin = r.template("rin");
@@ -1514,6 +1518,15 @@ fn define_alu(
     e.enc_i32_i64(x86_udivmodx, rec_div.opcodes(&DIV).rrr(6));
 
     e.enc_i32_i64(x86_smulx, rec_mulx.opcodes(&IMUL_RDX_RAX).rrr(5));
+    // With BMI2, prefer MULX: it only pins the multiplicand to %rdx and leaves both halves of
+    // the result (and the flags) free, instead of clobbering %rax and %rdx.
+    e.enc32_isap(x86_umulx.bind(I32), rec_mulx_vex.opcodes(&MULX), use_bmi2);
+    e.enc64_isap(x86_umulx.bind(I32), rec_mulx_vex.opcodes(&MULX), use_bmi2);
+    e.enc64_isap(
+        x86_umulx.bind(I64),
+        rec_mulx_vex.opcodes(&MULX).w(),
+        use_bmi2,
+    );
     e.enc_i32_i64(x86_umulx, rec_mulx.opcodes(&MUL).rrr(4));
 
     // Binary bitwise ops.
@@ -1579,13 +1592,14 @@ fn define_alu(
     e.enc64_isap(popcnt.bind(I32), rec_urm.opcodes(&POPCNT).rex(), use_popcnt);
     e.enc64_isap(popcnt.bind(I32), rec_urm.opcodes(&POPCNT), use_popcnt);
 
-    // Count leading zero bits.
+    // Count leading and trailing zero bits. LZCNT and TZCNT return the operand width for a zero
+    // input, so these encodings take precedence over the BSR/BSF expansion in `legalize.rs` and
+    // need no zero check.
     e.enc32_isap(clz.bind(I32), rec_urm.opcodes(&LZCNT), use_lzcnt);
     e.enc64_isap(clz.bind(I64), rec_urm.opcodes(&LZCNT).rex().w(), use_lzcnt);
     e.enc64_isap(clz.bind(I32), rec_urm.opcodes(&LZCNT).rex(), use_lzcnt);
     e.enc64_isap(clz.bind(I32), rec_urm.opcodes(&LZCNT), use_lzcnt);
 
-    // Count trailing zero bits.
     e.enc32_isap(ctz.bind(I32), rec_urm.opcodes(&TZCNT), use_bmi1);
     e.enc64_isap(ctz.bind(I64), rec_urm.opcodes(&TZCNT).rex().w(), use_bmi1);
     e.enc64_isap(ctz.bind(I32), rec_urm.opcodes(&TZCNT).rex(), use_bmi1);
@@ -1656,6 +1670,7 @@ fn define_simd(
     let ishl_imm = shared.by_name("ishl_imm");
     let load = shared.by_name("load");
     let load_complex = shared.by_name("load_complex");
+    let popcnt = shared.by_name("popcnt");
     let raw_bitcast = shared.by_name("raw_bitcast");
     let regfill = shared.by_name("regfill");
     let regmove = shared.by_name("regmove");
@@ -1762,6 +1777,7 @@ fn define_simd(
     let use_ssse3_simd = settings.predicate_by_name("use_ssse3_simd");
     let use_sse41_simd = settings.predicate_by_name("use_sse41_simd");
     let use_sse42_simd = settings.predicate_by_name("use_sse42_simd");
+    let use_avx512bitalg_vl_simd = settings.predicate_by_name("use_avx512bitalg_vl_simd");
     let use_avx512dq_simd = settings.predicate_by_name("use_avx512dq_simd");
     let use_avx512vl_simd = settings.predicate_by_name("use_avx512vl_simd");
 
@@ -2224,6 +2240,13 @@ fn define_simd(
         );
     }
 
+    // SIMD population count for I8x16 using AVX512; otherwise it is legalized with PSHUFB.
+    e.enc_32_64_maybe_isap(
+        popcnt.bind(vector(I8, sse_vector_size)),
+        rec_evex_reg_rm_128.opcodes(&VPOPCNTB),
+        Some(use_avx512bitalg_vl_simd),
+    );
+
     // SIMD integer average with rounding.
     for (ty, opcodes) in &[(I8, &PAVGB[..]), (I16, &PAVGW[..])] {
         let avgr = avg_round.bind(vector(*ty, sse_vector_size));
@@ -2518,6 +2541,7 @@ fn define_control_flow(
     let formats = &shared_defs.formats;
 
     // Shorthands for instructions.
+    let br_icmp = shared.by_name("br_icmp");
     let brff = shared.by_name("brff");
     let brif = shared.by_name("brif");
     let brnz = shared.by_name("brnz");
@@ -2543,6 +2567,8 @@ fn define_control_flow(
     let rec_call_id = r.template("call_id");
     let rec_call_plt_id = r.template("call_plt_id");
     let rec_call_r = r.template("call_r");
+    let rec_cmpjccb = r.template("cmpjccb");
+    let rec_cmpjccd = r.template("cmpjccd");
     let rec_debugtrap = r.recipe("debugtrap");
     let rec_indirect_jmp = r.template("indirect_jmp");
     let rec_jmpb = r.template("jmpb");
@@ -2611,6 +2637,12 @@ fn define_control_flow(
     e.enc_i32_i64_explicit_rex(brnz, rec_tjccb.opcodes(&JUMP_SHORT_IF_NOT_EQUAL));
     e.enc_i32_i64_explicit_rex(brnz, rec_tjccd.opcodes(&TEST_REG));
 
+    // Compare and branch as a single cmp + Jcc pair, rather than through a flags value that would
+    // let other instructions be scheduled between the two. The Jcc opcode is derived from the
+    // condition code when emitting.
+    e.enc_i32_i64_explicit_rex(br_icmp, rec_cmpjccb.opcodes(&CMP_REG));
+    e.enc_i32_i64_explicit_rex(br_icmp, rec_cmpjccd.opcodes(&CMP_REG));
+
     // Branch on a b1 value in a register only looks at the low 8 bits. See also
     // bint encodings below.
     //
@@ -53,9 +53,11 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     let insts = &shared.instructions;
     let band = insts.by_name("band");
     let bor = insts.by_name("bor");
+    let bxor_imm = insts.by_name("bxor_imm");
     let clz = insts.by_name("clz");
     let ctz = insts.by_name("ctz");
     let fcmp = insts.by_name("fcmp");
+    let ffcmp = insts.by_name("ffcmp");
     let fcvt_from_uint = insts.by_name("fcvt_from_uint");
     let fcvt_to_sint = insts.by_name("fcvt_to_sint");
     let fcvt_to_uint = insts.by_name("fcvt_to_uint");
@@ -76,6 +78,7 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     let smulhi = insts.by_name("smulhi");
     let srem = insts.by_name("srem");
     let tls_value = insts.by_name("tls_value");
+    let trueff = insts.by_name("trueff");
     let udiv = insts.by_name("udiv");
     let umulhi = insts.by_name("umulhi");
     let ushr = insts.by_name("ushr");
@@ -156,23 +159,30 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     let floatcc_uno = Literal::enumerator_for(&imm.floatcc, "uno");
     let floatcc_one = Literal::enumerator_for(&imm.floatcc, "one");
 
-    // Equality needs an explicit `ord` test which checks the parity bit.
-    expand.legalize(
-        def!(a = fcmp(floatcc_eq, x, y)),
-        vec![
-            def!(a1 = fcmp(floatcc_ord, x, y)),
-            def!(a2 = fcmp(floatcc_ueq, x, y)),
-            def!(a = band(a1, a2)),
-        ],
-    );
-    expand.legalize(
-        def!(a = fcmp(floatcc_ne, x, y)),
-        vec![
-            def!(a1 = fcmp(floatcc_uno, x, y)),
-            def!(a2 = fcmp(floatcc_one, x, y)),
-            def!(a = bor(a1, a2)),
-        ],
-    );
+    // Equality needs an explicit `ord` test which checks the parity bit. A single `ucomiss` or
+    // `ucomisd` sets both the zero and the parity flags, so compare once and read both flags.
+    let f = var("f");
+    for ty in &[F32, F64] {
+        let fcmp_ = &fcmp.bind(*ty);
+        expand.legalize(
+            def!(a = fcmp_(floatcc_eq, x, y)),
+            vec![
+                def!(f = ffcmp(x, y)),
+                def!(a1 = trueff(floatcc_ord, f)),
+                def!(a2 = trueff(floatcc_ueq, f)),
+                def!(a = band(a1, a2)),
+            ],
+        );
+        expand.legalize(
+            def!(a = fcmp_(floatcc_ne, x, y)),
+            vec![
+                def!(f = ffcmp(x, y)),
+                def!(a1 = trueff(floatcc_uno, f)),
+                def!(a2 = trueff(floatcc_one, f)),
+                def!(a = bor(a1, a2)),
+            ],
+        );
+    }
 
     let floatcc_lt = &Literal::enumerator_for(&imm.floatcc, "lt");
     let floatcc_gt = &Literal::enumerator_for(&imm.floatcc, "gt");
@@ -183,7 +193,10 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     let floatcc_uge = &Literal::enumerator_for(&imm.floatcc, "uge");
     let floatcc_ule = &Literal::enumerator_for(&imm.floatcc, "ule");
 
-    // Inequalities that need to be reversed.
+    // Inequalities that need to be reversed. The reversed condition codes are all directly
+    // supported, so the rewritten `fcmp` is encoded when the legalizer revisits it and never
+    // matches another pattern here. Each entry generates a single `cond` comparison guarding a
+    // one-instruction replacement, so there is nothing to gain from a parameterized entry.
     for &(cc, rev_cc) in &[
         (floatcc_lt, floatcc_gt),
         (floatcc_le, floatcc_ge),
@@ -193,7 +206,10 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
         expand.legalize(def!(a = fcmp(cc, x, y)), vec![def!(a = fcmp(rev_cc, y, x))]);
     }
 
-    // We need to modify the CFG for min/max legalization.
+    // We need to modify the CFG for min/max legalization. The vector version is branchless
+    // because CMPPS produces a lane mask to fix up NaNs with; there is no scalar `fcmp` producing
+    // a mask here, and the cheap `bor`/`band` of both operand orders alone would not produce a
+    // canonical NaN when one of the inputs is a NaN.
     expand.custom_legalize(fmin, "expand_minmax");
     expand.custom_legalize(fmax, "expand_minmax");
 
@@ -205,39 +221,50 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     expand.custom_legalize(fcvt_to_sint_sat, "expand_fcvt_to_sint_sat");
     expand.custom_legalize(fcvt_to_uint_sat, "expand_fcvt_to_uint_sat");
 
-    // Count leading and trailing zeroes, for baseline x86_64
-    let c_minus_one = var("c_minus_one");
-    let c_thirty_one = var("c_thirty_one");
+    // Count leading and trailing zeroes, for baseline x86_64. LZCNT and TZCNT define the result
+    // for a zero input, so with `has_lzcnt` / `has_bmi1` the `clz` / `ctz` instructions are
+    // encoded directly (see the `use_lzcnt` / `use_bmi1` encodings) and never expanded here.
+    //
+    // The zero-input fix-up `selectif` is encoded as CMOVcc reading the flags produced by BSR or
+    // BSF, so no setcc/test sequence is involved: each expansion is the bit scan, a constant
+    // load and a `cmovz`, plus the final XOR for `clz`.
+    //
+    // For a BSR bit index `i` in [0, 63], `63 - i == i ^ 63`; selecting 127 for a zero input
+    // makes the same XOR produce 64. Unlike `isub`, the XOR takes an immediate operand, so the
+    // constant does not need a register. The same holds for 32 bits with 31 and 63.
+    //
+    // BMI1's BLSR (`x & (x - 1)`) and BLSI (`x & -x`) can't be targeted from here: legalization
+    // patterns only ever match a single instruction, and `band` itself is always legal. The same
+    // goes for collapsing shift/mask/or chains into BMI2's PDEP and PEXT.
     let c_thirty_two = var("c_thirty_two");
     let c_sixty_three = var("c_sixty_three");
     let c_sixty_four = var("c_sixty_four");
+    let c_one_twenty_seven = var("c_one_twenty_seven");
     let index1 = var("index1");
     let r2flags = var("r2flags");
     let index2 = var("index2");
 
     let intcc_eq = Literal::enumerator_for(&imm.intcc, "eq");
-    let imm64_minus_one = Literal::constant(&imm.imm64, -1);
+    let imm64_31 = Literal::constant(&imm.imm64, 31);
     let imm64_63 = Literal::constant(&imm.imm64, 63);
+    let imm64_127 = Literal::constant(&imm.imm64, 127);
     expand.legalize(
         def!(a = clz.I64(x)),
         vec![
-            def!(c_minus_one = iconst(imm64_minus_one)),
-            def!(c_sixty_three = iconst(imm64_63)),
+            def!(c_one_twenty_seven = iconst(imm64_127)),
             def!((index1, r2flags) = x86_bsr(x)),
-            def!(index2 = selectif(intcc_eq, r2flags, c_minus_one, index1)),
-            def!(a = isub(c_sixty_three, index2)),
+            def!(index2 = selectif(intcc_eq, r2flags, c_one_twenty_seven, index1)),
+            def!(a = bxor_imm(index2, imm64_63)),
         ],
     );
 
-    let imm64_31 = Literal::constant(&imm.imm64, 31);
     expand.legalize(
         def!(a = clz.I32(x)),
         vec![
-            def!(c_minus_one = iconst(imm64_minus_one)),
-            def!(c_thirty_one = iconst(imm64_31)),
+            def!(c_sixty_three = iconst(imm64_63)),
             def!((index1, r2flags) = x86_bsr(x)),
-            def!(index2 = selectif(intcc_eq, r2flags, c_minus_one, index1)),
-            def!(a = isub(c_thirty_one, index2)),
+            def!(index2 = selectif(intcc_eq, r2flags, c_sixty_three, index1)),
+            def!(a = bxor_imm(index2, imm64_31)),
         ],
     );
 
@@ -261,10 +288,22 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
         ],
     );
 
-    // Population count for baseline x86_64
+    // Population count for baseline x86_64. With `has_popcnt`, `popcnt` is encoded directly as
+    // POPCNT (see the `use_popcnt` encodings), and this expansion is never reached.
     let x = var("x");
     let r = var("r");
 
+    // This is the classic SWAR formulation: sum adjacent bits into 2-bit fields, then 2-bit
+    // fields into nibbles, then nibbles into bytes, and finally add up all the bytes with a
+    // multiply. The two halves of the nibble step are independent, which keeps the dependency
+    // chain short; the mask constants are shared between the steps that use them.
+    //
+    // The final byte sum could also be done with PSADBW against zero, but that needs the SIMD
+    // vector moves, which are only encoded when `enable_simd` is set. A GPR <-> XMM round trip
+    // also costs about as much as the IMUL it would replace, so the multiply is kept.
+    //
+    // Both widths use the same sequence; the masks are the 64-bit ones truncated to the width,
+    // and the byte sum ends up in the top byte.
     let qv3 = var("qv3");
     let qv4 = var("qv4");
     let qv5 = var("qv5");
@@ -276,78 +315,39 @@ pub(crate) fn define(shared: &mut SharedDefinitions, x86_instructions: &Instruct
     let qv11 = var("qv11");
     let qv12 = var("qv12");
     let qv13 = var("qv13");
-    let qv14 = var("qv14");
-    let qv15 = var("qv15");
-    let qc77 = var("qc77");
+    let qc55 = var("qc55");
+    let qc33 = var("qc33");
     #[allow(non_snake_case)]
     let qc0F = var("qc0F");
     let qc01 = var("qc01");
 
     let imm64_1 = Literal::constant(&imm.imm64, 1);
+    let imm64_2 = Literal::constant(&imm.imm64, 2);
     let imm64_4 = Literal::constant(&imm.imm64, 4);
-    expand.legalize(
-        def!(r = popcnt.I64(x)),
-        vec![
-            def!(qv3 = ushr_imm(x, imm64_1)),
-            def!(qc77 = iconst(Literal::constant(&imm.imm64, 0x7777_7777_7777_7777))),
-            def!(qv4 = band(qv3, qc77)),
-            def!(qv5 = isub(x, qv4)),
-            def!(qv6 = ushr_imm(qv4, imm64_1)),
-            def!(qv7 = band(qv6, qc77)),
-            def!(qv8 = isub(qv5, qv7)),
-            def!(qv9 = ushr_imm(qv7, imm64_1)),
-            def!(qv10 = band(qv9, qc77)),
-            def!(qv11 = isub(qv8, qv10)),
-            def!(qv12 = ushr_imm(qv11, imm64_4)),
-            def!(qv13 = iadd(qv11, qv12)),
-            def!(qc0F = iconst(Literal::constant(&imm.imm64, 0x0F0F_0F0F_0F0F_0F0F))),
-            def!(qv14 = band(qv13, qc0F)),
-            def!(qc01 = iconst(Literal::constant(&imm.imm64, 0x0101_0101_0101_0101))),
-            def!(qv15 = imul(qv14, qc01)),
-            def!(r = ushr_imm(qv15, Literal::constant(&imm.imm64, 56))),
-        ],
-    );
-
-    let lv3 = var("lv3");
-    let lv4 = var("lv4");
-    let lv5 = var("lv5");
-    let lv6 = var("lv6");
-    let lv7 = var("lv7");
-    let lv8 = var("lv8");
-    let lv9 = var("lv9");
-    let lv10 = var("lv10");
-    let lv11 = var("lv11");
-    let lv12 = var("lv12");
-    let lv13 = var("lv13");
-    let lv14 = var("lv14");
-    let lv15 = var("lv15");
-    let lc77 = var("lc77");
-    #[allow(non_snake_case)]
-    let lc0F = var("lc0F");
-    let lc01 = var("lc01");
-
-    expand.legalize(
-        def!(r = popcnt.I32(x)),
-        vec![
-            def!(lv3 = ushr_imm(x, imm64_1)),
-            def!(lc77 = iconst(Literal::constant(&imm.imm64, 0x7777_7777))),
-            def!(lv4 = band(lv3, lc77)),
-            def!(lv5 = isub(x, lv4)),
-            def!(lv6 = ushr_imm(lv4, imm64_1)),
-            def!(lv7 = band(lv6, lc77)),
-            def!(lv8 = isub(lv5, lv7)),
-            def!(lv9 = ushr_imm(lv7, imm64_1)),
-            def!(lv10 = band(lv9, lc77)),
-            def!(lv11 = isub(lv8, lv10)),
-            def!(lv12 = ushr_imm(lv11, imm64_4)),
-            def!(lv13 = iadd(lv11, lv12)),
-            def!(lc0F = iconst(Literal::constant(&imm.imm64, 0x0F0F_0F0F))),
-            def!(lv14 = band(lv13, lc0F)),
-            def!(lc01 = iconst(Literal::constant(&imm.imm64, 0x0101_0101))),
-            def!(lv15 = imul(lv14, lc01)),
-            def!(r = ushr_imm(lv15, Literal::constant(&imm.imm64, 24))),
-        ],
-    );
+    for &(ty, bits) in &[(I64, 64), (I32, 32)] {
+        let mask = |m: u64| Literal::constant(&imm.imm64, (m >> (64 - bits)) as i64);
+        expand.legalize(
+            def!(r = popcnt.ty(x)),
+            vec![
+                def!(qv3 = ushr_imm(x, imm64_1)),
+                def!(qc55 = iconst(mask(0x5555_5555_5555_5555))),
+                def!(qv4 = band(qv3, qc55)),
+                def!(qv5 = isub(x, qv4)),
+                def!(qc33 = iconst(mask(0x3333_3333_3333_3333))),
+                def!(qv6 = band(qv5, qc33)),
+                def!(qv7 = ushr_imm(qv5, imm64_2)),
+                def!(qv8 = band(qv7, qc33)),
+                def!(qv9 = iadd(qv6, qv8)),
+                def!(qv10 = ushr_imm(qv9, imm64_4)),
+                def!(qv11 = iadd(qv9, qv10)),
+                def!(qc0F = iconst(mask(0x0F0F_0F0F_0F0F_0F0F))),
+                def!(qv12 = band(qv11, qc0F)),
+                def!(qc01 = iconst(mask(0x0101_0101_0101_0101))),
+                def!(qv13 = imul(qv12, qc01)),
+                def!(r = ushr_imm(qv13, Literal::constant(&imm.imm64, bits - 8))),
+            ],
+        );
+    }
 
     expand.custom_legalize(ineg, "convert_ineg");
     expand.custom_legalize(tls_value, "expand_tls_value");
@@ -387,6 +387,7 @@ fn define_simd(
     let fmax = insts.by_name("fmax");
     let fmin = insts.by_name("fmin");
     let fneg = insts.by_name("fneg");
+    let iadd = insts.by_name("iadd");
     let iadd_imm = insts.by_name("iadd_imm");
     let icmp = insts.by_name("icmp");
     let imax = insts.by_name("imax");
@@ -396,6 +397,7 @@ fn define_simd(
     let insertlane = insts.by_name("insertlane");
     let ishl = insts.by_name("ishl");
     let ishl_imm = insts.by_name("ishl_imm");
+    let popcnt = insts.by_name("popcnt");
     let raw_bitcast = insts.by_name("raw_bitcast");
     let scalar_to_vector = insts.by_name("scalar_to_vector");
     let splat = insts.by_name("splat");
@@ -439,6 +441,9 @@ fn define_simd(
     let u128_zeroes = constant(vec![0x00; 16]);
     let u128_ones = constant(vec![0xff; 16]);
     let u128_seventies = constant(vec![0x70; 16]);
+    let u128_low_nibbles = constant(vec![0x0f; 16]);
+    let u128_nibble_popcnts = constant(vec![0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4]);
+    let imm64_four = Literal::constant(&imm.imm64, 4);
     let a = var("a");
     let b = var("b");
     let c = var("c");
@@ -542,6 +547,30 @@ fn define_simd(
         );
     }
 
+    // SIMD popcnt (i8x16): without a byte-wise population count instruction, look up the bit
+    // count of each nibble in a 16-entry table with PSHUFB and add the two halves. There is no
+    // byte-wise shift on x86, so the high nibbles are shifted as 16-bit lanes and then masked.
+    {
+        let popcnt = popcnt.bind(vector(I8, sse_vector_size));
+        let raw_bitcast_i16x8 = raw_bitcast.bind(vector(I16, sse_vector_size));
+        let raw_bitcast_i8x16 = raw_bitcast.bind(vector(I8, sse_vector_size));
+        narrow.legalize(
+            def!(a = popcnt(x)),
+            vec![
+                def!(b = vconst(u128_low_nibbles)),
+                def!(c = band(x, b)),
+                def!(d = raw_bitcast_i16x8(x)),
+                def!(e = ushr_imm(d, imm64_four)),
+                def!(f = raw_bitcast_i8x16(e)),
+                def!(g = band(f, b)),
+                def!(h = vconst(u128_nibble_popcnts)),
+                def!(y = x86_pshufb(h, c)),
+                def!(z = x86_pshufb(h, g)),
+                def!(a = iadd(y, z)),
+            ],
+        );
+    }
+
     // SIMD bnot
     for ty in ValueType::all_lane_types().filter(allowed_simd_type) {
         let bnot = bnot.bind(vector(ty, sse_vector_size));
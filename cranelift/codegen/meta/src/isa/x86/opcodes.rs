@@ -272,6 +272,10 @@ pub static MOVZX_WORD: [u8; 2] = [0x0f, 0xb7];
 /// Unsigned multiply for {16,32,64}-bit.
 pub static MUL: [u8; 1] = [0xf7];
 
+/// Unsigned multiply of %rdx by r/m without affecting flags, high half in reg and low half in
+/// vvvv (BMI2, VEX encoded).
+pub static MULX: [u8; 4] = [0xf2, 0x0f, 0x38, 0xf6];
+
 /// Multiply packed double-precision floating-point values from xmm2/mem to xmm1 and store result
 /// in xmm1 (SSE2).
 pub static MULPD: [u8; 3] = [0x66, 0x0f, 0x59];
@@ -504,6 +508,10 @@ pub static PMULLD: [u8; 4] = [0x66, 0x0f, 0x38, 0x40];
 /// bits of each product in xmm1 (AVX512VL/DQ). Requires an EVEX encoding.
 pub static VPMULLQ: [u8; 4] = [0x66, 0x0f, 0x38, 0x40];
 
+/// Count the number of one bits in each packed byte integer of xmm2/m128 and store the results
+/// in xmm1 (AVX512BITALG/VL). Requires an EVEX encoding.
+pub static VPOPCNTB: [u8; 4] = [0x66, 0x0f, 0x38, 0x54];
+
 /// Multiply packed unsigned doubleword integers in xmm1 by packed unsigned doubleword integers
 /// in xmm2/m128, and store the quadword results in xmm1 (SSE2).
 pub static PMULUDQ: [u8; 3] = [0x66, 0x0f, 0xf4];
@@ -1,4 +1,5 @@
 //! Encoding recipes for x86/x86_64.
+use std::collections::HashMap;
 use std::rc::Rc;
 
 use cranelift_codegen_shared::isa::x86::EncodingBits;
@@ -22,55 +23,63 @@ pub(crate) struct RecipeGroup<'builder> {
     /// Memoized registers description, to pass it to builders later.
     regs: &'builder IsaRegs,
 
-    /// All the recipes explicitly created in this file. This is different from the final set of
-    /// recipes, which is definitive only once encodings have generated new recipes on the fly.
-    recipes: Vec<EncodingRecipe>,
+    /// All the recipes explicitly created in this file, by name. This is different from the final
+    /// set of recipes, which is definitive only once encodings have generated new recipes on the
+    /// fly.
+    recipes: HashMap<String, EncodingRecipe>,
 
-    /// All the recipe templates created in this file.
-    templates: Vec<Rc<Template<'builder>>>,
+    /// All the recipe templates created in this file, by name.
+    templates: HashMap<String, Rc<Template<'builder>>>,
 }
 
 impl<'builder> RecipeGroup<'builder> {
     fn new(regs: &'builder IsaRegs) -> Self {
         Self {
             regs,
-            recipes: Vec::new(),
-            templates: Vec::new(),
+            recipes: HashMap::new(),
+            templates: HashMap::new(),
         }
     }
     fn add_recipe(&mut self, recipe: EncodingRecipeBuilder) {
-        self.recipes.push(recipe.build());
+        let recipe = recipe.build();
+        assert!(
+            !self.recipes.contains_key(&recipe.name),
+            "duplicate recipe name: {}",
+            recipe.name
+        );
+        self.recipes.insert(recipe.name.clone(), recipe);
     }
     fn add_template_recipe(&mut self, recipe: EncodingRecipeBuilder) -> Rc<Template<'builder>> {
-        let template = Rc::new(Template::new(recipe, self.regs));
-        self.templates.push(template.clone());
-        template
+        self.add_template(Template::new(recipe, self.regs))
     }
     fn add_template_inferred(
         &mut self,
         recipe: EncodingRecipeBuilder,
         infer_function: &'static str,
     ) -> Rc<Template<'builder>> {
-        let template =
-            Rc::new(Template::new(recipe, self.regs).inferred_rex_compute_size(infer_function));
-        self.templates.push(template.clone());
-        template
+        self.add_template(
+            Template::new(recipe, self.regs).inferred_rex_compute_size(infer_function),
+        )
     }
     fn add_template(&mut self, template: Template<'builder>) -> Rc<Template<'builder>> {
+        let name = template.name().to_string();
+        assert!(
+            !self.templates.contains_key(&name),
+            "duplicate template name: {}",
+            name
+        );
         let template = Rc::new(template);
-        self.templates.push(template.clone());
+        self.templates.insert(name, template.clone());
         template
     }
     pub fn recipe(&self, name: &str) -> &EncodingRecipe {
         self.recipes
-            .iter()
-            .find(|recipe| recipe.name == name)
+            .get(name)
             .unwrap_or_else(|| panic!("unknown recipe name: {}. Try template?", name))
     }
     pub fn template(&self, name: &str) -> &Template {
         self.templates
-            .iter()
-            .find(|recipe| recipe.name() == name)
+            .get(name)
             .unwrap_or_else(|| panic!("unknown template name: {}. Try recipe?", name))
     }
 }
@@ -108,57 +117,64 @@ impl<'builder> RecipeGroup<'builder> {
 // could be simplified.
 
 /// Given a sequence of opcode bytes, compute the recipe name prefix and encoding bits.
+///
+/// This is a slice match and a few bit operations, with no allocation, so it is recomputed for
+/// every template build rather than memoized.
 fn decode_opcodes(op_bytes: &[u8], rrr: u16, w: u16) -> (&'static str, u16) {
     let enc = EncodingBits::new(op_bytes, rrr, w);
     (enc.prefix().recipe_name_prefix(), enc.bits())
 }
 
+/// Emit code shared by the register-register recipes: opcode with a REX prefix covering both
+/// inputs, followed by a ModR/M byte with `in_reg0` in `rm` and `in_reg1` in `reg`.
+const EMIT_RR: &str = r#"
+    {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
+    modrm_rr(in_reg0, in_reg1, sink);
+"#;
+
+/// Same as `EMIT_RR`, with the two inputs swapped in the REX prefix and the ModR/M byte.
+const EMIT_RR_SWAPPED: &str = r#"
+    {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
+    modrm_rr(in_reg1, in_reg0, sink);
+"#;
+
 /// Given a snippet of Rust code (or None), replace the `PUT_OP` macro with the
-/// corresponding `put_*` function from the `binemit.rs` module.
+/// corresponding `put_*` function from the `binemit.rs` module. Snippets that emit their prefix
+/// by hand are returned as is, without building the function name or copying the code.
 fn replace_put_op(code: Option<String>, prefix: &str) -> Option<String> {
-    code.map(|code| code.replace("{{PUT_OP}}", &format!("put_{}", prefix.to_lowercase())))
+    code.map(|code| {
+        if code.contains("{{PUT_OP}}") {
+            let mut put_op = String::with_capacity("put_".len() + prefix.len());
+            put_op.push_str("put_");
+            put_op.extend(prefix.chars().map(|c| c.to_ascii_lowercase()));
+            code.replace("{{PUT_OP}}", &put_op)
+        } else {
+            code
+        }
+    })
 }
 
 /// Replaces constraints to a REX-prefixed register class by the equivalent non-REX register class.
-fn replace_nonrex_constraints(
-    regs: &IsaRegs,
-    constraints: Vec<OperandConstraint>,
-) -> Vec<OperandConstraint> {
-    constraints
-        .into_iter()
-        .map(|constraint| match constraint {
-            OperandConstraint::RegClass(rc_index) => {
-                let new_rc_index = if rc_index == regs.class_by_name("GPR") {
-                    regs.class_by_name("GPR8")
-                } else if rc_index == regs.class_by_name("FPR") {
-                    regs.class_by_name("FPR8")
-                } else {
-                    rc_index
-                };
-                OperandConstraint::RegClass(new_rc_index)
+fn replace_nonrex_constraints(regs: &IsaRegs, constraints: &mut [OperandConstraint]) {
+    // Look the classes up once rather than by name for every constraint.
+    let (gpr, gpr8) = (regs.class_by_name("GPR"), regs.class_by_name("GPR8"));
+    let (fpr, fpr8) = (regs.class_by_name("FPR"), regs.class_by_name("FPR8"));
+    for constraint in constraints {
+        if let OperandConstraint::RegClass(rc_index) = constraint {
+            if *rc_index == gpr {
+                *rc_index = gpr8;
+            } else if *rc_index == fpr {
+                *rc_index = fpr8;
             }
-            _ => constraint,
-        })
-        .collect()
+        }
+    }
 }
 
-fn replace_evex_constraints(
-    _: &IsaRegs,
-    constraints: Vec<OperandConstraint>,
-) -> Vec<OperandConstraint> {
-    constraints
-        .into_iter()
-        .map(|constraint| match constraint {
-            OperandConstraint::RegClass(rc_index) => {
-                // FIXME(#1306) this should be able to upgrade the register class to FPR32 as in
-                // `replace_nonrex_constraints` above, e.g. When FPR32 is re-added, add back in the
-                // rc_index conversion to FPR32. In the meantime, this is effectively a no-op
-                // conversion--the register class stays the same.
-                OperandConstraint::RegClass(rc_index)
-            }
-            _ => constraint,
-        })
-        .collect()
+fn replace_evex_constraints(_: &IsaRegs, _: &mut [OperandConstraint]) {
+    // FIXME(#1306) this should be able to upgrade the register class to FPR32 as in
+    // `replace_nonrex_constraints` above, e.g. When FPR32 is re-added, add back in the
+    // rc_index conversion to FPR32. In the meantime, this is effectively a no-op
+    // conversion--the register class stays the same.
 }
 
 /// Specifies how the prefix (e.g. REX) is emitted by a Recipe.
@@ -183,6 +199,9 @@ pub enum RecipePrefixKind {
 
     /// The Recipe must hardcode the emission of an EVEX prefix.
     Evex,
+
+    /// The Recipe must hardcode the emission of a three-byte VEX prefix.
+    Vex,
 }
 
 impl Default for RecipePrefixKind {
@@ -201,8 +220,9 @@ pub(crate) struct Template<'builder> {
     /// Description of registers, used in the build() method.
     regs: &'builder IsaRegs,
 
-    /// The recipe template, which is to be specialized (by copy).
-    recipe: EncodingRecipeBuilder,
+    /// The recipe template, which is to be specialized (by copy). It is shared between the
+    /// copies made by the setters below, and only cloned when a copy is built.
+    recipe: Rc<EncodingRecipeBuilder>,
 
     /// How is the REX prefix emitted?
     rex_kind: RecipePrefixKind,
@@ -226,7 +246,7 @@ impl<'builder> Template<'builder> {
     fn new(recipe: EncodingRecipeBuilder, regs: &'builder IsaRegs) -> Self {
         Self {
             regs,
-            recipe,
+            recipe: Rc::new(recipe),
             rex_kind: RecipePrefixKind::default(),
             inferred_rex_compute_size: None,
             when_prefixed: None,
@@ -259,7 +279,9 @@ impl<'builder> Template<'builder> {
         }
     }
 
-    // Copy setters.
+    // Copy setters. Each one returns a copy of the template with a single encoding parameter
+    // changed; the copies share the recipe builder, so chains like `.opcodes(..).rrr(..).w()`
+    // only copy a handful of scalar fields.
     pub fn opcodes(&self, op_bytes: &'static [u8]) -> Self {
         assert!(!op_bytes.is_empty());
         let mut copy = self.clone();
@@ -291,6 +313,8 @@ impl<'builder> Template<'builder> {
             self.rex_kind != RecipePrefixKind::NeverEmitRex,
             "Template requires no REX prefix."
         );
+        // Only the few templates restricted to non-REX registers (the `_abcd` byte forms) carry a
+        // REX-prefixed alternative; every other template just switches its own prefix kind.
         if let Some(prefixed) = &self.when_prefixed {
             let mut ret = prefixed.rex();
             // Forward specialized parameters.
@@ -317,61 +341,65 @@ impl<'builder> Template<'builder> {
         copy
     }
 
-    pub fn build(mut self) -> (EncodingRecipe, u16) {
+    pub fn build(self) -> (EncodingRecipe, u16) {
+        let mut recipe = Rc::try_unwrap(self.recipe).unwrap_or_else(|recipe| (*recipe).clone());
         let (opcode, bits) = decode_opcodes(&self.op_bytes, self.rrr_bits, self.w_bit);
 
-        let (recipe_name, size_addendum) = match self.rex_kind {
+        let op_size = self.op_bytes.len() as u64;
+        let (prefix_kind, size_addendum) = match self.rex_kind {
             RecipePrefixKind::Unspecified | RecipePrefixKind::NeverEmitRex => {
                 // Ensure the operands are limited to non-REX constraints.
-                let operands_in = self.recipe.operands_in.unwrap_or_default();
-                self.recipe.operands_in = Some(replace_nonrex_constraints(self.regs, operands_in));
-                let operands_out = self.recipe.operands_out.unwrap_or_default();
-                self.recipe.operands_out =
-                    Some(replace_nonrex_constraints(self.regs, operands_out));
-
-                (opcode.into(), self.op_bytes.len() as u64)
-            }
-            RecipePrefixKind::AlwaysEmitRex => {
-                ("Rex".to_string() + opcode, self.op_bytes.len() as u64 + 1)
+                map_constraints(&mut recipe, self.regs, replace_nonrex_constraints);
+                ("", op_size)
             }
+            RecipePrefixKind::AlwaysEmitRex => ("Rex", op_size + 1),
             RecipePrefixKind::InferRex => {
                 assert_eq!(self.w_bit, 0, "A REX.W bit always requires a REX prefix; avoid using `infer_rex().w()` and use `rex().w()` instead.");
                 // Hook up the right function for inferred compute_size().
                 assert!(
                     self.inferred_rex_compute_size.is_some(),
                     "InferRex recipe '{}' needs an inferred_rex_compute_size function.",
-                    &self.recipe.name
+                    &recipe.name
                 );
-                self.recipe.compute_size = self.inferred_rex_compute_size;
+                recipe.compute_size = self.inferred_rex_compute_size;
 
-                ("DynRex".to_string() + opcode, self.op_bytes.len() as u64)
+                ("DynRex", op_size)
             }
             RecipePrefixKind::Evex => {
                 // Allow the operands to expand limits to EVEX constraints.
-                let operands_in = self.recipe.operands_in.unwrap_or_default();
-                self.recipe.operands_in = Some(replace_evex_constraints(self.regs, operands_in));
-                let operands_out = self.recipe.operands_out.unwrap_or_default();
-                self.recipe.operands_out = Some(replace_evex_constraints(self.regs, operands_out));
-
-                ("Evex".to_string() + opcode, 4 + 1)
+                map_constraints(&mut recipe, self.regs, replace_evex_constraints);
+                ("Evex", 4 + 1)
             }
+            // The VEX prefix carries the R and B register extensions itself.
+            RecipePrefixKind::Vex => ("Vex", 3 + 1),
         };
+        let recipe_name = prefix_kind.to_string() + opcode;
 
-        self.recipe.base_size += size_addendum;
+        recipe.base_size += size_addendum;
 
         // Branch ranges are relative to the end of the instruction.
         // For InferRex, the range should be the minimum, assuming no REX.
-        if let Some(range) = self.recipe.branch_range.as_mut() {
+        if let Some(range) = recipe.branch_range.as_mut() {
             range.inst_size += size_addendum;
         }
 
-        self.recipe.emit = replace_put_op(self.recipe.emit, &recipe_name);
-        self.recipe.name = recipe_name + &self.recipe.name;
+        recipe.emit = replace_put_op(recipe.emit, &recipe_name);
+        recipe.name = recipe_name + &recipe.name;
 
-        (self.recipe.build(), bits)
+        (recipe.build(), bits)
     }
 }
 
+/// Rewrites the input and output operand constraints of the recipe in place with `replace`.
+fn map_constraints(
+    recipe: &mut EncodingRecipeBuilder,
+    regs: &IsaRegs,
+    replace: fn(&IsaRegs, &mut [OperandConstraint]),
+) {
+    replace(regs, recipe.operands_in.get_or_insert_with(Vec::new));
+    replace(regs, recipe.operands_out.get_or_insert_with(Vec::new));
+}
+
 /// Returns a predicate checking that the "cond" field of the instruction contains one of the
 /// directly supported floating point condition codes.
 fn supported_floatccs_predicate(
@@ -510,6 +538,10 @@ pub(crate) fn define<'shared>(
     ));
 
     // Macro: conditional jump over a ud2.
+    //
+    // The bytes are emitted one at a time on purpose: `CodeSink::put2` writes its word in host
+    // byte order and binemit tests print it as a single 16-bit value, so it is only meant for
+    // immediates and displacements, not for pairs of opcode bytes.
     recipes.add_recipe(
         EncodingRecipeBuilder::new("trapif", &formats.int_cond_trap, 4)
             .operands_in(vec![reg_rflags])
@@ -553,12 +585,7 @@ pub(crate) fn define<'shared>(
         EncodingRecipeBuilder::new("rr", &formats.binary, 1)
             .operands_in(vec![gpr, gpr])
             .operands_out(vec![0])
-            .emit(
-                r#"
-                        {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                        modrm_rr(in_reg0, in_reg1, sink);
-                    "#,
-            ),
+            .emit(EMIT_RR),
         "size_with_inferred_rex_for_inreg0_inreg1",
     );
 
@@ -567,12 +594,7 @@ pub(crate) fn define<'shared>(
         EncodingRecipeBuilder::new("rrx", &formats.binary, 1)
             .operands_in(vec![gpr, gpr])
             .operands_out(vec![0])
-            .emit(
-                r#"
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        modrm_rr(in_reg1, in_reg0, sink);
-                    "#,
-            ),
+            .emit(EMIT_RR_SWAPPED),
         "size_with_inferred_rex_for_inreg0_inreg1",
     );
 
@@ -581,12 +603,7 @@ pub(crate) fn define<'shared>(
         EncodingRecipeBuilder::new("fa", &formats.binary, 1)
             .operands_in(vec![fpr, fpr])
             .operands_out(vec![0])
-            .emit(
-                r#"
-                    {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                    modrm_rr(in_reg1, in_reg0, sink);
-                "#,
-            ),
+            .emit(EMIT_RR_SWAPPED),
         "size_with_inferred_rex_for_inreg0_inreg1",
     );
 
@@ -595,12 +612,7 @@ pub(crate) fn define<'shared>(
         EncodingRecipeBuilder::new("fax", &formats.binary, 1)
             .operands_in(vec![fpr, fpr])
             .operands_out(vec![1])
-            .emit(
-                r#"
-                    {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                    modrm_rr(in_reg0, in_reg1, sink);
-                "#,
-            ),
+            .emit(EMIT_RR),
         // The operand order does not matter for calculating whether a REX prefix is needed.
         "size_with_inferred_rex_for_inreg0_inreg1",
     );
@@ -707,18 +719,18 @@ pub(crate) fn define<'shared>(
             ),
     );
 
+    let emit_urm_noflags = r#"
+        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
+        modrm_rr(in_reg0, out_reg0, sink);
+    "#;
+
     // XX /r. Same as urm, but doesn't clobber FLAGS.
     let urm_noflags = recipes.add_template_recipe(
         EncodingRecipeBuilder::new("urm_noflags", &formats.unary, 1)
             .operands_in(vec![gpr])
             .operands_out(vec![gpr])
             .clobbers_flags(false)
-            .emit(
-                r#"
-                    {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                    modrm_rr(in_reg0, out_reg0, sink);
-                "#,
-            ),
+            .emit(emit_urm_noflags),
     );
 
     // XX /r. Same as urm_noflags, but input limited to ABCD.
@@ -728,12 +740,7 @@ pub(crate) fn define<'shared>(
                 .operands_in(vec![abcd])
                 .operands_out(vec![gpr])
                 .clobbers_flags(false)
-                .emit(
-                    r#"
-                    {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                    modrm_rr(in_reg0, out_reg0, sink);
-                "#,
-                ),
+                .emit(emit_urm_noflags),
             regs,
         )
         .when_prefixed(urm_noflags),
@@ -905,6 +912,30 @@ pub(crate) fn define<'shared>(
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg1"),
     );
 
+    // VEX XX /r for mulx: inputs in %rdx, r. Outputs in reg(hi) and vvvv(lo), any registers.
+    recipes.add_template(
+        Template::new(
+            EncodingRecipeBuilder::new("mulx_vex", &formats.binary, 1)
+                .operands_in(vec![
+                    OperandConstraint::FixedReg(reg_rdx),
+                    OperandConstraint::RegClass(gpr),
+                ])
+                .operands_out(vec![
+                    OperandConstraint::RegClass(gpr),
+                    OperandConstraint::RegClass(gpr),
+                ])
+                .clobbers_flags(false)
+                .emit(
+                    r#"
+                        put_vex3(bits, out_reg1, out_reg0, in_reg1, sink); // params: reg, vvvv, rm
+                        modrm_rr(in_reg1, out_reg1, sink);
+                    "#,
+                ),
+            regs,
+        )
+        .rex_kind(RecipePrefixKind::Vex),
+    );
+
     // XX /r for BLEND* instructions
     recipes.add_template_inferred(
         EncodingRecipeBuilder::new("blend", &formats.ternary, 1)
@@ -1193,7 +1224,7 @@ pub(crate) fn define<'shared>(
             .operands_in(vec![gpr])
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     {{PUT_OP}}(bits | (in_reg0 & 7), rex1(in_reg0), sink);
                 "#,
             ),
@@ -1496,6 +1527,15 @@ pub(crate) fn define<'shared>(
         let has_no_offset =
             InstructionPredicate::new_is_field_equal(&*formats.store, "offset", "0".into());
 
+        // Each store shape shares its emit code between the GPR, ABCD and FPR variants.
+        let emit_st = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
+            modrm_base(in_reg1, in_reg0, sink);
+        "#;
+
         // XX /r register-indirect store with no offset.
         let st = recipes.add_template_recipe(
             EncodingRecipeBuilder::new("st", &formats.store, 1)
@@ -1503,23 +1543,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_no_offset.clone())
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_or_offset_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else if needs_offset(in_reg1) {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_rm(in_reg1, in_reg0, sink);
-                        }
-                    "#,
-                ),
+                .emit(emit_st),
         );
 
         // XX /r register-indirect store with no offset.
@@ -1531,23 +1555,7 @@ pub(crate) fn define<'shared>(
                     .inst_predicate(has_no_offset.clone())
                     .clobbers_flags(false)
                     .compute_size("size_plus_maybe_sib_or_offset_for_inreg_1")
-                    .emit(
-                        r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else if needs_offset(in_reg1) {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_rm(in_reg1, in_reg0, sink);
-                        }
-                    "#,
-                    ),
+                    .emit(emit_st),
                 regs,
             )
             .when_prefixed(st),
@@ -1560,29 +1568,27 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_no_offset)
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_or_offset_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else if needs_offset(in_reg1) {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_rm(in_reg1, in_reg0, sink);
-                        }
-                    "#,
-                ),
+                .emit(emit_st),
             "size_plus_maybe_sib_or_offset_inreg1_plus_rex_prefix_for_inreg0_inreg1",
         );
 
+        // The disp8 and disp32 forms are kept as separate recipes rather than one recipe picking
+        // the displacement width at emit time: each recipe then has a fixed base size, so the
+        // compute-size functions only account for SIB bytes and REX prefixes, and the
+        // instruction predicates let the legal-encoding search pick the shortest form.
         let has_small_offset =
             InstructionPredicate::new_is_signed_int(&*formats.store, "offset", 8, 0);
 
+        let emit_st_disp8 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
+            modrm_base_disp8(in_reg1, in_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put1(offset as u8);
+        "#;
+
         // XX /r register-indirect store with 8-bit offset.
         let st_disp8 = recipes.add_template_recipe(
             EncodingRecipeBuilder::new("stDisp8", &formats.store, 2)
@@ -1590,22 +1596,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_small_offset.clone())
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
+                .emit(emit_st_disp8),
         );
 
         // XX /r register-indirect store with 8-bit offset.
@@ -1617,22 +1608,7 @@ pub(crate) fn define<'shared>(
                     .inst_predicate(has_small_offset.clone())
                     .clobbers_flags(false)
                     .compute_size("size_plus_maybe_sib_for_inreg_1")
-                    .emit(
-                        r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                    ),
+                    .emit(emit_st_disp8),
                 regs,
             )
             .when_prefixed(st_disp8),
@@ -1645,47 +1621,27 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_small_offset)
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp8(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
+                .emit(emit_st_disp8),
             "size_plus_maybe_sib_inreg1_plus_rex_prefix_for_inreg0_inreg1",
         );
 
+        let emit_st_disp32 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
+            modrm_base_disp32(in_reg1, in_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put4(offset as u32);
+        "#;
+
         // XX /r register-indirect store with 32-bit offset.
         let st_disp32 = recipes.add_template_recipe(
             EncodingRecipeBuilder::new("stDisp32", &formats.store, 5)
                 .operands_in(vec![gpr, gpr])
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp32(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp32(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
+                .emit(emit_st_disp32),
         );
 
         // XX /r register-indirect store with 32-bit offset.
@@ -1696,22 +1652,7 @@ pub(crate) fn define<'shared>(
                     .operands_in(vec![abcd, gpr])
                     .clobbers_flags(false)
                     .compute_size("size_plus_maybe_sib_for_inreg_1")
-                    .emit(
-                        r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp32(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp32(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                    ),
+                    .emit(emit_st_disp32),
                 regs,
             )
             .when_prefixed(st_disp32),
@@ -1723,22 +1664,7 @@ pub(crate) fn define<'shared>(
                 .operands_in(vec![fpr, gpr])
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                        if needs_sib_byte(in_reg1) {
-                            modrm_sib_disp32(in_reg0, sink);
-                            sib_noindex(in_reg1, sink);
-                        } else {
-                            modrm_disp32(in_reg1, in_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
+                .emit(emit_st_disp32),
             "size_plus_maybe_sib_inreg1_plus_rex_prefix_for_inreg0_inreg1",
         );
     }
@@ -1750,212 +1676,91 @@ pub(crate) fn define<'shared>(
         let has_no_offset =
             InstructionPredicate::new_is_field_equal(&*formats.store_complex, "offset", "0".into());
 
-        // XX /r register-indirect store with index and no offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndex", &formats.store_complex, 2)
-                .operands_in(vec![gpr, gpr, gpr])
-                .inst_predicate(has_no_offset.clone())
-                .clobbers_flags(false)
-                .compute_size("size_plus_maybe_offset_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        // The else branch always inserts an SIB byte.
-                        if needs_offset(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_sib(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                        }
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and no offset.
-        // Only ABCD allowed for stored value. This is for byte stores with no REX.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndex_abcd", &formats.store_complex, 2)
-                .operands_in(vec![abcd, gpr, gpr])
-                .inst_predicate(has_no_offset.clone())
-                .clobbers_flags(false)
-                .compute_size("size_plus_maybe_offset_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        // The else branch always inserts an SIB byte.
-                        if needs_offset(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_sib(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                        }
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and no offset of FPR.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fstWithIndex", &formats.store_complex, 2)
-                .operands_in(vec![fpr, gpr, gpr])
-                .inst_predicate(has_no_offset)
-                .clobbers_flags(false)
-                .compute_size("size_plus_maybe_offset_for_inreg_1")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        // The else branch always inserts an SIB byte.
-                        if needs_offset(in_reg1) {
-                            modrm_sib_disp8(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_sib(in_reg0, sink);
-                            sib(0, in_reg2, in_reg1, sink);
-                        }
-                    "#,
-                ),
-        );
+        // Each store shape shares its emit code between the GPR, ABCD and FPR variants.
+        let emit_st_with_index = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
+            modrm_base_index(0, in_reg2, in_reg1, in_reg0, sink);
+        "#;
+
+        // XX /r register-indirect store with index and no offset, of a GPR, of an ABCD register
+        // (for byte stores with no REX), or of an FPR.
+        for &(name, value) in &[
+            ("stWithIndex", gpr),
+            ("stWithIndex_abcd", abcd),
+            ("fstWithIndex", fpr),
+        ] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.store_complex, 2)
+                    .operands_in(vec![value, gpr, gpr])
+                    .inst_predicate(has_no_offset.clone())
+                    .clobbers_flags(false)
+                    .compute_size("size_plus_maybe_offset_for_inreg_1")
+                    .emit(emit_st_with_index),
+            );
+        }
 
         let has_small_offset =
             InstructionPredicate::new_is_signed_int(&*formats.store_complex, "offset", 8, 0);
 
-        // XX /r register-indirect store with index and 8-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndexDisp8", &formats.store_complex, 3)
-                .operands_in(vec![gpr, gpr, gpr])
-                .inst_predicate(has_small_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp8(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and 8-bit offset.
-        // Only ABCD allowed for stored value. This is for byte stores with no REX.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndexDisp8_abcd", &formats.store_complex, 3)
-                .operands_in(vec![abcd, gpr, gpr])
-                .inst_predicate(has_small_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp8(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and 8-bit offset of FPR.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fstWithIndexDisp8", &formats.store_complex, 3)
-                .operands_in(vec![fpr, gpr, gpr])
-                .inst_predicate(has_small_offset)
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp8(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
-        );
+        let emit_st_with_index_disp8 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
+            modrm_sib_disp8(in_reg0, sink);
+            sib(0, in_reg2, in_reg1, sink);
+            let offset: i32 = offset.into();
+            sink.put1(offset as u8);
+        "#;
+
+        // XX /r register-indirect store with index and 8-bit offset, of a GPR, of an ABCD register
+        // (for byte stores with no REX), or of an FPR.
+        for &(name, value) in &[
+            ("stWithIndexDisp8", gpr),
+            ("stWithIndexDisp8_abcd", abcd),
+            ("fstWithIndexDisp8", fpr),
+        ] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.store_complex, 3)
+                    .operands_in(vec![value, gpr, gpr])
+                    .inst_predicate(has_small_offset.clone())
+                    .clobbers_flags(false)
+                    .emit(emit_st_with_index_disp8),
+            );
+        }
 
         let has_big_offset =
             InstructionPredicate::new_is_signed_int(&*formats.store_complex, "offset", 32, 0);
 
-        // XX /r register-indirect store with index and 32-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndexDisp32", &formats.store_complex, 6)
-                .operands_in(vec![gpr, gpr, gpr])
-                .inst_predicate(has_big_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp32(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and 32-bit offset.
-        // Only ABCD allowed for stored value. This is for byte stores with no REX.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("stWithIndexDisp32_abcd", &formats.store_complex, 6)
-                .operands_in(vec![abcd, gpr, gpr])
-                .inst_predicate(has_big_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp32(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
-        );
-
-        // XX /r register-indirect store with index and 32-bit offset of FPR.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fstWithIndexDisp32", &formats.store_complex, 6)
-                .operands_in(vec![fpr, gpr, gpr])
-                .inst_predicate(has_big_offset)
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
-                        modrm_sib_disp32(in_reg0, sink);
-                        sib(0, in_reg2, in_reg1, sink);
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
-        );
+        let emit_st_with_index_disp32 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg1, in_reg0, in_reg2), sink);
+            modrm_sib_disp32(in_reg0, sink);
+            sib(0, in_reg2, in_reg1, sink);
+            let offset: i32 = offset.into();
+            sink.put4(offset as u32);
+        "#;
+
+        // XX /r register-indirect store with index and 32-bit offset, of a GPR, of an ABCD register
+        // (for byte stores with no REX), or of an FPR.
+        for &(name, value) in &[
+            ("stWithIndexDisp32", gpr),
+            ("stWithIndexDisp32_abcd", abcd),
+            ("fstWithIndexDisp32", fpr),
+        ] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.store_complex, 6)
+                    .operands_in(vec![value, gpr, gpr])
+                    .inst_predicate(has_big_offset.clone())
+                    .clobbers_flags(false)
+                    .emit(emit_st_with_index_disp32),
+            );
+        }
     }
 
     // Unary spill with SIB and 32-bit displacement.
@@ -1966,7 +1771,7 @@ pub(crate) fn define<'shared>(
             .clobbers_flags(false)
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     let base = stk_base(out_stk0.base);
                     {{PUT_OP}}(bits, rex2(base, in_reg0), sink);
                     modrm_sib_disp32(in_reg0, sink);
@@ -1977,14 +1782,14 @@ pub(crate) fn define<'shared>(
     );
 
     // Like spillSib32, but targeting an FPR rather than a GPR.
-    recipes.add_template_recipe(
+    recipes.add_template_inferred(
         EncodingRecipeBuilder::new("fspillSib32", &formats.unary, 6)
             .operands_in(vec![fpr])
             .operands_out(vec![stack_fpr32])
             .clobbers_flags(false)
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     let base = stk_base(out_stk0.base);
                     {{PUT_OP}}(bits, rex2(base, in_reg0), sink);
                     modrm_sib_disp32(in_reg0, sink);
@@ -1992,6 +1797,7 @@ pub(crate) fn define<'shared>(
                     sink.put4(out_stk0.offset as u32);
                 "#,
             ),
+        "size_with_inferred_rex_for_inreg0",
     );
 
     // Regspill using RSP-relative addressing.
@@ -2001,7 +1807,7 @@ pub(crate) fn define<'shared>(
             .clobbers_flags(false)
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     let dst = StackRef::sp(dst, &func.stack_slots);
                     let base = stk_base(dst.base);
                     {{PUT_OP}}(bits, rex2(base, src), sink);
@@ -2019,7 +1825,7 @@ pub(crate) fn define<'shared>(
             .clobbers_flags(false)
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     let dst = StackRef::sp(dst, &func.stack_slots);
                     let base = stk_base(dst.base);
                     {{PUT_OP}}(bits, rex2(base, src), sink);
@@ -2039,6 +1845,19 @@ pub(crate) fn define<'shared>(
         let has_no_offset =
             InstructionPredicate::new_is_field_equal(&*formats.load, "offset", "0".into());
 
+        // Each load shape shares its emit code between the GPR and FPR variants.
+        //
+        // The no-offset form already covers %rbp/%r13 bases: `modrm_base` falls back to a zero
+        // disp8 for them and the compute-size function accounts for that byte. As for stores, the
+        // disp8 and disp32 forms stay separate recipes with fixed base sizes.
+        let emit_ld = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
+            modrm_base(in_reg0, out_reg0, sink);
+        "#;
+
         // XX /r load with no offset.
         recipes.add_template_recipe(
             EncodingRecipeBuilder::new("ld", &formats.load, 1)
@@ -2047,23 +1866,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_no_offset.clone())
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_or_offset_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else if needs_offset(in_reg0) {
-                            modrm_disp8(in_reg0, out_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_rm(in_reg0, out_reg0, sink);
-                        }
-                    "#,
-                ),
+                .emit(emit_ld),
         );
 
         // XX /r float load with no offset.
@@ -2074,29 +1877,23 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_no_offset)
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_or_offset_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else if needs_offset(in_reg0) {
-                            modrm_disp8(in_reg0, out_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_rm(in_reg0, out_reg0, sink);
-                        }
-                    "#,
-                ),
+                .emit(emit_ld),
             "size_plus_maybe_sib_or_offset_for_inreg_0_plus_rex_prefix_for_inreg0_outreg0",
         );
 
         let has_small_offset =
             InstructionPredicate::new_is_signed_int(&*formats.load, "offset", 8, 0);
 
+        let emit_ld_disp8 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
+            modrm_base_disp8(in_reg0, out_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put1(offset as u8);
+        "#;
+
         // XX /r load with 8-bit offset.
         recipes.add_template_recipe(
             EncodingRecipeBuilder::new("ldDisp8", &formats.load, 2)
@@ -2105,22 +1902,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_small_offset.clone())
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib_disp8(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else {
-                            modrm_disp8(in_reg0, out_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
+                .emit(emit_ld_disp8),
         );
 
         // XX /r float load with 8-bit offset.
@@ -2131,28 +1913,23 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_small_offset)
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib_disp8(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else {
-                            modrm_disp8(in_reg0, out_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
+                .emit(emit_ld_disp8),
             "size_plus_maybe_sib_for_inreg_0_plus_rex_prefix_for_inreg0_outreg0",
         );
 
         let has_big_offset =
             InstructionPredicate::new_is_signed_int(&*formats.load, "offset", 32, 0);
 
+        let emit_ld_disp32 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
+            modrm_base_disp32(in_reg0, out_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put4(offset as u32);
+        "#;
+
         // XX /r load with 32-bit offset.
         recipes.add_template_recipe(
             EncodingRecipeBuilder::new("ldDisp32", &formats.load, 5)
@@ -2161,22 +1938,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_big_offset.clone())
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib_disp32(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else {
-                            modrm_disp32(in_reg0, out_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
+                .emit(emit_ld_disp32),
         );
 
         // XX /r float load with 32-bit offset.
@@ -2187,22 +1949,7 @@ pub(crate) fn define<'shared>(
                 .inst_predicate(has_big_offset)
                 .clobbers_flags(false)
                 .compute_size("size_plus_maybe_sib_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex2(in_reg0, out_reg0), sink);
-                        if needs_sib_byte(in_reg0) {
-                            modrm_sib_disp32(out_reg0, sink);
-                            sib_noindex(in_reg0, sink);
-                        } else {
-                            modrm_disp32(in_reg0, out_reg0, sink);
-                        }
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
+                .emit(emit_ld_disp32),
             "size_plus_maybe_sib_for_inreg_0_plus_rex_prefix_for_inreg0_outreg0",
         );
     }
@@ -2214,149 +1961,79 @@ pub(crate) fn define<'shared>(
         let has_no_offset =
             InstructionPredicate::new_is_field_equal(&*formats.load_complex, "offset", "0".into());
 
-        // XX /r load with index and no offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("ldWithIndex", &formats.load_complex, 2)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![gpr])
-                .inst_predicate(has_no_offset.clone())
-                .clobbers_flags(false)
-                .compute_size("size_plus_maybe_offset_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        // The else branch always inserts an SIB byte.
-                        if needs_offset(in_reg0) {
-                            modrm_sib_disp8(out_reg0, sink);
-                            sib(0, in_reg1, in_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_sib(out_reg0, sink);
-                            sib(0, in_reg1, in_reg0, sink);
-                        }
-                    "#,
-                ),
-        );
-
-        // XX /r float load with index and no offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fldWithIndex", &formats.load_complex, 2)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![fpr])
-                .inst_predicate(has_no_offset)
-                .clobbers_flags(false)
-                .compute_size("size_plus_maybe_offset_for_inreg_0")
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        // The else branch always inserts an SIB byte.
-                        if needs_offset(in_reg0) {
-                            modrm_sib_disp8(out_reg0, sink);
-                            sib(0, in_reg1, in_reg0, sink);
-                            sink.put1(0);
-                        } else {
-                            modrm_sib(out_reg0, sink);
-                            sib(0, in_reg1, in_reg0, sink);
-                        }
-                    "#,
-                ),
-        );
+        // Each load shape shares its emit code between the GPR and FPR variants.
+        let emit_ld_with_index = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
+            modrm_base_index(0, in_reg1, in_reg0, out_reg0, sink);
+        "#;
+
+        // XX /r load with index and no offset, into a GPR or into an FPR.
+        for &(name, value) in &[("ldWithIndex", gpr), ("fldWithIndex", fpr)] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.load_complex, 2)
+                    .operands_in(vec![gpr, gpr])
+                    .operands_out(vec![value])
+                    .inst_predicate(has_no_offset.clone())
+                    .clobbers_flags(false)
+                    .compute_size("size_plus_maybe_offset_for_inreg_0")
+                    .emit(emit_ld_with_index),
+            );
+        }
 
         let has_small_offset =
             InstructionPredicate::new_is_signed_int(&*formats.load_complex, "offset", 8, 0);
 
-        // XX /r load with index and 8-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("ldWithIndexDisp8", &formats.load_complex, 3)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![gpr])
-                .inst_predicate(has_small_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        modrm_sib_disp8(out_reg0, sink);
-                        sib(0, in_reg1, in_reg0, sink);
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
-        );
-
-        // XX /r float load with 8-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fldWithIndexDisp8", &formats.load_complex, 3)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![fpr])
-                .inst_predicate(has_small_offset)
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        modrm_sib_disp8(out_reg0, sink);
-                        sib(0, in_reg1, in_reg0, sink);
-                        let offset: i32 = offset.into();
-                        sink.put1(offset as u8);
-                    "#,
-                ),
-        );
+        let emit_ld_with_index_disp8 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
+            modrm_sib_disp8(out_reg0, sink);
+            sib(0, in_reg1, in_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put1(offset as u8);
+        "#;
+
+        // XX /r load with index and 8-bit offset, into a GPR or into an FPR.
+        for &(name, value) in &[("ldWithIndexDisp8", gpr), ("fldWithIndexDisp8", fpr)] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.load_complex, 3)
+                    .operands_in(vec![gpr, gpr])
+                    .operands_out(vec![value])
+                    .inst_predicate(has_small_offset.clone())
+                    .clobbers_flags(false)
+                    .emit(emit_ld_with_index_disp8),
+            );
+        }
 
         let has_big_offset =
             InstructionPredicate::new_is_signed_int(&*formats.load_complex, "offset", 32, 0);
 
-        // XX /r load with index and 32-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("ldWithIndexDisp32", &formats.load_complex, 6)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![gpr])
-                .inst_predicate(has_big_offset.clone())
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        modrm_sib_disp32(out_reg0, sink);
-                        sib(0, in_reg1, in_reg0, sink);
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
-        );
-
-        // XX /r float load with index and 32-bit offset.
-        recipes.add_template_recipe(
-            EncodingRecipeBuilder::new("fldWithIndexDisp32", &formats.load_complex, 6)
-                .operands_in(vec![gpr, gpr])
-                .operands_out(vec![fpr])
-                .inst_predicate(has_big_offset)
-                .clobbers_flags(false)
-                .emit(
-                    r#"
-                        if !flags.notrap() {
-                            sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
-                        }
-                        {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
-                        modrm_sib_disp32(out_reg0, sink);
-                        sib(0, in_reg1, in_reg0, sink);
-                        let offset: i32 = offset.into();
-                        sink.put4(offset as u32);
-                    "#,
-                ),
-        );
+        let emit_ld_with_index_disp32 = r#"
+            if !flags.notrap() {
+                sink.trap(TrapCode::HeapOutOfBounds, func.srclocs[inst]);
+            }
+            {{PUT_OP}}(bits, rex3(in_reg0, out_reg0, in_reg1), sink);
+            modrm_sib_disp32(out_reg0, sink);
+            sib(0, in_reg1, in_reg0, sink);
+            let offset: i32 = offset.into();
+            sink.put4(offset as u32);
+        "#;
+
+        // XX /r load with index and 32-bit offset, into a GPR or into an FPR.
+        for &(name, value) in &[("ldWithIndexDisp32", gpr), ("fldWithIndexDisp32", fpr)] {
+            recipes.add_template_recipe(
+                EncodingRecipeBuilder::new(name, &formats.load_complex, 6)
+                    .operands_in(vec![gpr, gpr])
+                    .operands_out(vec![value])
+                    .inst_predicate(has_big_offset.clone())
+                    .clobbers_flags(false)
+                    .emit(emit_ld_with_index_disp32),
+            );
+        }
     }
 
     // Unary fill with SIB and 32-bit displacement.
@@ -2377,7 +2054,7 @@ pub(crate) fn define<'shared>(
     );
 
     // Like fillSib32, but targeting an FPR rather than a GPR.
-    recipes.add_template_recipe(
+    recipes.add_template_inferred(
         EncodingRecipeBuilder::new("ffillSib32", &formats.unary, 6)
             .operands_in(vec![stack_fpr32])
             .operands_out(vec![fpr])
@@ -2391,6 +2068,7 @@ pub(crate) fn define<'shared>(
                     sink.put4(in_stk0.offset as u32);
                 "#,
             ),
+        "size_with_inferred_rex_for_outreg0",
     );
 
     // Regfill with RSP-relative 32-bit displacement.
@@ -2432,16 +2110,9 @@ pub(crate) fn define<'shared>(
     recipes.add_template_recipe(
         EncodingRecipeBuilder::new("call_id", &formats.call, 4).emit(
             r#"
-            sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+            stack_overflow_trap(func, inst, sink);
             {{PUT_OP}}(bits, BASE_REX, sink);
-            // The addend adjusts for the difference between the end of the
-            // instruction and the beginning of the immediate field.
-            sink.reloc_external(func.srclocs[inst],
-                                Reloc::X86CallPCRel4,
-                                &func.dfg.ext_funcs[func_ref].name,
-                                -4);
-            sink.put4(0);
-            sink.add_call_site(opcode, func.srclocs[inst]);
+            call_disp4(Reloc::X86CallPCRel4, func_ref, func, inst, sink);
         "#,
         ),
     );
@@ -2449,14 +2120,9 @@ pub(crate) fn define<'shared>(
     recipes.add_template_recipe(
         EncodingRecipeBuilder::new("call_plt_id", &formats.call, 4).emit(
             r#"
-            sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+            stack_overflow_trap(func, inst, sink);
             {{PUT_OP}}(bits, BASE_REX, sink);
-            sink.reloc_external(func.srclocs[inst],
-                                Reloc::X86CallPLTRel4,
-                                &func.dfg.ext_funcs[func_ref].name,
-                                -4);
-            sink.put4(0);
-            sink.add_call_site(opcode, func.srclocs[inst]);
+            call_disp4(Reloc::X86CallPLTRel4, func_ref, func, inst, sink);
         "#,
         ),
     );
@@ -2466,7 +2132,7 @@ pub(crate) fn define<'shared>(
             .operands_in(vec![gpr])
             .emit(
                 r#"
-                    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+                    stack_overflow_trap(func, inst, sink);
                     {{PUT_OP}}(bits, rex1(in_reg0), sink);
                     modrm_r_bits(in_reg0, bits, sink);
                     sink.add_call_site(opcode, func.srclocs[inst]);
@@ -2474,6 +2140,10 @@ pub(crate) fn define<'shared>(
             ),
     );
 
+    // `ret` and the unconditional jumps below only ever use the REX-less `Op1` templates, whose
+    // `put_op1` is a single `put1` of the opcode byte once its debug assertions are compiled out.
+    // Hard-coding the opcodes here would gain nothing and would detach the emitted bytes from the
+    // encoding bits recorded in the tables.
     recipes.add_template_recipe(
         EncodingRecipeBuilder::new("ret", &formats.multiary, 0)
             .emit("{{PUT_OP}}(bits, BASE_REX, sink);"),
@@ -2587,14 +2257,8 @@ pub(crate) fn define<'shared>(
             .emit(
                 r#"
                     {{PUT_OP}}(bits, rex3(in_reg1, out_reg0, in_reg0), sink);
-                    if needs_offset(in_reg1) {
-                        modrm_sib_disp8(out_reg0, sink);
-                        sib(imm.trailing_zeros() as u8, in_reg0, in_reg1, sink);
-                        sink.put1(0);
-                    } else {
-                        modrm_sib(out_reg0, sink);
-                        sib(imm.trailing_zeros() as u8, in_reg0, in_reg1, sink);
-                    }
+                    let scale = imm.trailing_zeros() as u8;
+                    modrm_base_index(scale, in_reg0, in_reg1, out_reg0, sink);
                 "#,
             ),
     );
@@ -2650,18 +2314,18 @@ pub(crate) fn define<'shared>(
     // Other instruction encodings accepting `b1` inputs have the same constraints and only look at
     // the low 8 bits of the input register.
 
+    let emit_seti = r#"
+        {{PUT_OP}}(bits | icc2opc(cond), rex1(out_reg0), sink);
+        modrm_r_bits(out_reg0, bits, sink);
+    "#;
+
     let seti = recipes.add_template(
         Template::new(
             EncodingRecipeBuilder::new("seti", &formats.int_cond, 1)
                 .operands_in(vec![reg_rflags])
                 .operands_out(vec![gpr])
                 .clobbers_flags(false)
-                .emit(
-                    r#"
-                    {{PUT_OP}}(bits | icc2opc(cond), rex1(out_reg0), sink);
-                    modrm_r_bits(out_reg0, bits, sink);
-                "#,
-                ),
+                .emit(emit_seti),
             regs,
         )
         .rex_kind(RecipePrefixKind::AlwaysEmitRex),
@@ -2673,29 +2337,24 @@ pub(crate) fn define<'shared>(
                 .operands_in(vec![reg_rflags])
                 .operands_out(vec![abcd])
                 .clobbers_flags(false)
-                .emit(
-                    r#"
-                    {{PUT_OP}}(bits | icc2opc(cond), rex1(out_reg0), sink);
-                    modrm_r_bits(out_reg0, bits, sink);
-                "#,
-                ),
+                .emit(emit_seti),
             regs,
         )
         .when_prefixed(seti),
     );
 
+    let emit_setf = r#"
+        {{PUT_OP}}(bits | fcc2opc(cond), rex1(out_reg0), sink);
+        modrm_r_bits(out_reg0, bits, sink);
+    "#;
+
     let setf = recipes.add_template(
         Template::new(
             EncodingRecipeBuilder::new("setf", &formats.float_cond, 1)
                 .operands_in(vec![reg_rflags])
                 .operands_out(vec![gpr])
                 .clobbers_flags(false)
-                .emit(
-                    r#"
-                    {{PUT_OP}}(bits | fcc2opc(cond), rex1(out_reg0), sink);
-                    modrm_r_bits(out_reg0, bits, sink);
-                "#,
-                ),
+                .emit(emit_setf),
             regs,
         )
         .rex_kind(RecipePrefixKind::AlwaysEmitRex),
@@ -2707,12 +2366,7 @@ pub(crate) fn define<'shared>(
                 .operands_in(vec![reg_rflags])
                 .operands_out(vec![abcd])
                 .clobbers_flags(false)
-                .emit(
-                    r#"
-                    {{PUT_OP}}(bits | fcc2opc(cond), rex1(out_reg0), sink);
-                    modrm_r_bits(out_reg0, bits, sink);
-                "#,
-                ),
+                .emit(emit_setf),
             regs,
         )
         .when_prefixed(setf),
@@ -2742,7 +2396,12 @@ pub(crate) fn define<'shared>(
         .inferred_rex_compute_size("size_with_inferred_rex_for_cmov"),
     );
 
-    // Bit scan forwards and reverse
+    // Bit scan forwards and reverse.
+    //
+    // BSF/BSR leave the destination unchanged for a zero input, so the CPU treats it as an input
+    // too. No zero idiom is emitted to break that dependency: the destination may be allocated to
+    // the same register as the source, and the zero case is already resolved by a `selectif` on
+    // the flags. Targets with BMI1/LZCNT use TZCNT/LZCNT instead, which have no such dependency.
     recipes.add_template(
         Template::new(
             EncodingRecipeBuilder::new("bsf_and_bsr", &formats.unary, 1)
@@ -2774,12 +2433,7 @@ pub(crate) fn define<'shared>(
                     OperandConstraint::FixedReg(reg_rflags),
                 ])
                 .clobbers_flags(true)
-                .emit(
-                    r#"
-                        {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                        modrm_rr(in_reg0, in_reg1, sink);
-                    "#,
-                ),
+                .emit(EMIT_RR),
             regs,
         )
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg0_inreg1"),
@@ -2796,12 +2450,7 @@ pub(crate) fn define<'shared>(
                 ])
                 .operands_out(vec![0])
                 .clobbers_flags(true)
-                .emit(
-                    r#"
-                        {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                        modrm_rr(in_reg0, in_reg1, sink);
-                    "#,
-                ),
+                .emit(EMIT_RR),
             regs,
         )
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg0_inreg1"),
@@ -2821,12 +2470,7 @@ pub(crate) fn define<'shared>(
                     OperandConstraint::FixedReg(reg_rflags),
                 ])
                 .clobbers_flags(true)
-                .emit(
-                    r#"
-                        {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                        modrm_rr(in_reg0, in_reg1, sink);
-                    "#,
-                ),
+                .emit(EMIT_RR),
             regs,
         )
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg0_inreg1"),
@@ -2840,12 +2484,7 @@ pub(crate) fn define<'shared>(
             EncodingRecipeBuilder::new("rcmp", &formats.binary, 1)
                 .operands_in(vec![gpr, gpr])
                 .operands_out(vec![reg_rflags])
-                .emit(
-                    r#"
-                        {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
-                        modrm_rr(in_reg0, in_reg1, sink);
-                    "#,
-                ),
+                .emit(EMIT_RR),
             regs,
         )
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg0_inreg1"),
@@ -2858,7 +2497,8 @@ pub(crate) fn define<'shared>(
             .operands_out(vec![reg_rflags])
             .emit(
                 r#"
-                    {{PUT_OP}}(bits, rex2(in_reg0, RU::rsp.into()), sink);
+                    // %rsp is one of the low eight registers, so it never sets REX.R.
+                    {{PUT_OP}}(bits, rex1(in_reg0), sink);
                     modrm_rr(in_reg0, RU::rsp.into(), sink);
                 "#,
             ),
@@ -2869,12 +2509,7 @@ pub(crate) fn define<'shared>(
         EncodingRecipeBuilder::new("fcmp", &formats.binary, 1)
             .operands_in(vec![fpr, fpr])
             .operands_out(vec![reg_rflags])
-            .emit(
-                r#"
-                    {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
-                    modrm_rr(in_reg1, in_reg0, sink);
-                "#,
-            ),
+            .emit(EMIT_RR_SWAPPED),
         "size_with_inferred_rex_for_inreg0_inreg1",
     );
 
@@ -2981,23 +2616,58 @@ pub(crate) fn define<'shared>(
         .inferred_rex_compute_size("size_with_inferred_rex_for_inreg0"),
     );
 
+    // Compare two GPRs and branch on the result. The cmp and the Jcc are emitted back to back so
+    // the pair can be macro-fused.
+    recipes.add_template_recipe(
+        EncodingRecipeBuilder::new("cmpjccb", &formats.branch_icmp, 1 + 2)
+            .operands_in(vec![gpr, gpr])
+            .branch_range((3, 8))
+            .emit(
+                r#"
+                    // cmp r, r.
+                    {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
+                    modrm_rr(in_reg0, in_reg1, sink);
+                    // Jcc instruction.
+                    sink.put1(0x70 | (icc2opc(cond) as u8));
+                    disp1(destination, func, sink);
+                "#,
+            ),
+    );
+
+    recipes.add_template_recipe(
+        EncodingRecipeBuilder::new("cmpjccd", &formats.branch_icmp, 1 + 6)
+            .operands_in(vec![gpr, gpr])
+            .branch_range((7, 32))
+            .emit(
+                r#"
+                    // cmp r, r.
+                    {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
+                    modrm_rr(in_reg0, in_reg1, sink);
+                    // Jcc instruction.
+                    sink.put1(0x0f);
+                    sink.put1(0x80 | (icc2opc(cond) as u8));
+                    disp4(destination, func, sink);
+                "#,
+            ),
+    );
+
     // 8-bit test-and-branch.
 
+    let emit_t8jccb = r#"
+        // test8 r, r.
+        {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
+        modrm_rr(in_reg0, in_reg0, sink);
+        // Jcc instruction.
+        sink.put1(bits as u8);
+        disp1(destination, func, sink);
+    "#;
+
     let t8jccb = recipes.add_template(
         Template::new(
             EncodingRecipeBuilder::new("t8jccb", &formats.branch, 1 + 2)
                 .operands_in(vec![gpr])
                 .branch_range((3, 8))
-                .emit(
-                    r#"
-                    // test8 r, r.
-                    {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
-                    modrm_rr(in_reg0, in_reg0, sink);
-                    // Jcc instruction.
-                    sink.put1(bits as u8);
-                    disp1(destination, func, sink);
-                "#,
-                ),
+                .emit(emit_t8jccb),
             regs,
         )
         .rex_kind(RecipePrefixKind::AlwaysEmitRex),
@@ -3008,37 +2678,28 @@ pub(crate) fn define<'shared>(
             EncodingRecipeBuilder::new("t8jccb_abcd", &formats.branch, 1 + 2)
                 .operands_in(vec![abcd])
                 .branch_range((3, 8))
-                .emit(
-                    r#"
-                    // test8 r, r.
-                    {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
-                    modrm_rr(in_reg0, in_reg0, sink);
-                    // Jcc instruction.
-                    sink.put1(bits as u8);
-                    disp1(destination, func, sink);
-                "#,
-                ),
+                .emit(emit_t8jccb),
             regs,
         )
         .when_prefixed(t8jccb),
     );
 
+    let emit_t8jccd = r#"
+        // test8 r, r.
+        {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
+        modrm_rr(in_reg0, in_reg0, sink);
+        // Jcc instruction.
+        sink.put1(0x0f);
+        sink.put1(bits as u8);
+        disp4(destination, func, sink);
+    "#;
+
     let t8jccd = recipes.add_template(
         Template::new(
             EncodingRecipeBuilder::new("t8jccd", &formats.branch, 1 + 6)
                 .operands_in(vec![gpr])
                 .branch_range((7, 32))
-                .emit(
-                    r#"
-                    // test8 r, r.
-                    {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
-                    modrm_rr(in_reg0, in_reg0, sink);
-                    // Jcc instruction.
-                    sink.put1(0x0f);
-                    sink.put1(bits as u8);
-                    disp4(destination, func, sink);
-                "#,
-                ),
+                .emit(emit_t8jccd),
             regs,
         )
         .rex_kind(RecipePrefixKind::AlwaysEmitRex),
@@ -3049,17 +2710,7 @@ pub(crate) fn define<'shared>(
             EncodingRecipeBuilder::new("t8jccd_abcd", &formats.branch, 1 + 6)
                 .operands_in(vec![abcd])
                 .branch_range((7, 32))
-                .emit(
-                    r#"
-                    // test8 r, r.
-                    {{PUT_OP}}((bits & 0xff00) | 0x84, rex2(in_reg0, in_reg0), sink);
-                    modrm_rr(in_reg0, in_reg0, sink);
-                    // Jcc instruction.
-                    sink.put1(0x0f);
-                    sink.put1(bits as u8);
-                    disp4(destination, func, sink);
-                "#,
-                ),
+                .emit(emit_t8jccd),
             regs,
         )
         .when_prefixed(t8jccd),
@@ -3067,9 +2718,12 @@ pub(crate) fn define<'shared>(
 
     // Worst case test-and-branch recipe for brz.b1 and brnz.b1 in 32-bit mode.
     // The register allocator can't handle a branch instruction with constrained
-    // operands like the t8jccd_abcd above. This variant can accept the b1 opernd in
-    // any register, but is is larger because it uses a 32-bit test instruction with
+    // operands like the t8jccd_abcd above. This variant can accept the b1 operand in
+    // any register, but it is larger because it uses a 32-bit test instruction with
     // a 0xff immediate.
+    //
+    // A shorter `test r32, r32` would not be correct: `setCC` and the other `b1` producers only
+    // define the low 8 bits of the register, so the upper bits must be masked off here.
 
     recipes.add_template_recipe(
         EncodingRecipeBuilder::new("t8jccd_long", &formats.branch, 5 + 6)
@@ -3119,10 +2773,7 @@ pub(crate) fn define<'shared>(
                         {{PUT_OP}}(bits, rex2(in_reg0, in_reg1), sink);
                         modrm_rr(in_reg0, in_reg1, sink);
                         // `setCC` instruction, no REX.
-                        let setcc = 0x90 | icc2opc(cond);
-                        sink.put1(0x0f);
-                        sink.put1(setcc as u8);
-                        modrm_rr(out_reg0, 0, sink);
+                        setcc_icc(cond, out_reg0, sink);
                     "#,
                 ),
             regs,
@@ -3162,10 +2813,7 @@ pub(crate) fn define<'shared>(
                             let imm: i64 = imm.into();
                             sink.put1(imm as u8);
                             // `setCC` instruction, no REX.
-                            let setcc = 0x90 | icc2opc(cond);
-                            sink.put1(0x0f);
-                            sink.put1(setcc as u8);
-                            modrm_rr(out_reg0, 0, sink);
+                            setcc_icc(cond, out_reg0, sink);
                         "#,
                     ),
                 regs,
@@ -3190,10 +2838,7 @@ pub(crate) fn define<'shared>(
                             let imm: i64 = imm.into();
                             sink.put4(imm as u32);
                             // `setCC` instruction, no REX.
-                            let setcc = 0x90 | icc2opc(cond);
-                            sink.put1(0x0f);
-                            sink.put1(setcc as u8);
-                            modrm_rr(out_reg0, 0, sink);
+                            setcc_icc(cond, out_reg0, sink);
                         "#,
                     ),
                 regs,
@@ -3231,27 +2876,7 @@ pub(crate) fn define<'shared>(
                     {{PUT_OP}}(bits, rex2(in_reg1, in_reg0), sink);
                     modrm_rr(in_reg1, in_reg0, sink);
                     // `setCC` instruction, no REX.
-                    use crate::ir::condcodes::FloatCC::*;
-                    let setcc = match cond {
-                        Ordered                    => 0x9b, // EQ|LT|GT => setnp (P=0)
-                        Unordered                  => 0x9a, // UN       => setp  (P=1)
-                        OrderedNotEqual            => 0x95, // LT|GT    => setne (Z=0),
-                        UnorderedOrEqual           => 0x94, // UN|EQ    => sete  (Z=1)
-                        GreaterThan                => 0x97, // GT       => seta  (C=0&Z=0)
-                        GreaterThanOrEqual         => 0x93, // GT|EQ    => setae (C=0)
-                        UnorderedOrLessThan        => 0x92, // UN|LT    => setb  (C=1)
-                        UnorderedOrLessThanOrEqual => 0x96, // UN|LT|EQ => setbe (Z=1|C=1)
-                        Equal |                       // EQ
-                        NotEqual |                    // UN|LT|GT
-                        LessThan |                    // LT
-                        LessThanOrEqual |             // LT|EQ
-                        UnorderedOrGreaterThan |      // UN|GT
-                        UnorderedOrGreaterThanOrEqual // UN|GT|EQ
-                        => panic!("{} not supported by fcscc", cond),
-                    };
-                    sink.put1(0x0f);
-                    sink.put1(setcc);
-                    modrm_rr(out_reg0, 0, sink);
+                    setcc_fcc(cond, out_reg0, sink);
                 "#,
             ),
     );
@@ -3304,9 +2929,7 @@ pub(crate) fn define<'shared>(
                     {{PUT_OP}}(bits, rex2(in_reg0, in_reg0), sink);
                     modrm_rr(in_reg0, in_reg0, sink);
                     // Check ZF = 1 flag to see if register holds 0.
-                    sink.put1(0x0f);
-                    sink.put1(0x94);
-                    modrm_rr(out_reg0, 0, sink);
+                    setcc_icc(IntCC::Equal, out_reg0, sink);
                 "#,
             ),
     );
@@ -3322,11 +2945,7 @@ pub(crate) fn define<'shared>(
                     modrm_r_bits(in_reg0, bits, sink);
                     sink.put1(0xff);
                     // `setCC` instruction, no REX.
-                    use crate::ir::condcodes::IntCC::*;
-                    let setcc = 0x90 | icc2opc(Equal);
-                    sink.put1(0x0f);
-                    sink.put1(setcc as u8);
-                    modrm_rr(out_reg0, 0, sink);
+                    setcc_icc(IntCC::Equal, out_reg0, sink);
                 "#,
             ),
     );
@@ -124,6 +124,10 @@ pub(crate) fn define(shared: &SettingGroup) -> SettingGroup {
         "use_avx512bitalg_simd",
         predicate!(shared_enable_simd && has_avx512bitalg),
     );
+    settings.add_predicate(
+        "use_avx512bitalg_vl_simd",
+        predicate!(shared_enable_simd && has_avx512bitalg && has_avx512vl),
+    );
     settings.add_predicate(
         "use_avx512dq_simd",
         predicate!(shared_enable_simd && has_avx512dq),
@@ -143,6 +147,7 @@ pub(crate) fn define(shared: &SettingGroup) -> SettingGroup {
 
     settings.add_predicate("use_popcnt", predicate!(has_popcnt && has_sse42));
     settings.add_predicate("use_bmi1", predicate!(has_bmi1));
+    settings.add_predicate("use_bmi2", predicate!(has_bmi2));
     settings.add_predicate("use_lzcnt", predicate!(has_lzcnt));
 
     // Some shared boolean values are used in x86 instruction predicates, so we need to group them
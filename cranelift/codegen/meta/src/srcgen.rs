@@ -7,6 +7,7 @@
 
 use std::cmp;
 use std::collections::{BTreeMap, BTreeSet};
+use std::fmt;
 use std::fs;
 use std::io::Write;
 use std::path;
@@ -19,7 +20,7 @@ static SHIFTWIDTH: usize = 4;
 /// strings.
 macro_rules! fmtln {
     ($fmt:ident, $fmtstring:expr, $($fmtargs:expr),*) => {
-        $fmt.line(format!($fmtstring, $($fmtargs),*));
+        $fmt.line_fmt(format_args!($fmtstring, $($fmtargs),*));
     };
 
     ($fmt:ident, $arg:expr) => {
@@ -70,11 +71,7 @@ impl Formatter {
 
     /// Get the current whitespace indentation in the form of a String.
     fn get_indent(&self) -> String {
-        if self.indent == 0 {
-            String::new()
-        } else {
-            format!("{:-1$}", " ", self.indent * SHIFTWIDTH)
-        }
+        " ".repeat(self.indent * SHIFTWIDTH)
     }
 
     /// Get a string containing whitespace outdented one level. Used for
@@ -88,7 +85,18 @@ impl Formatter {
 
     /// Add an indented line.
     pub fn line(&mut self, contents: impl AsRef<str>) {
-        let indented_line = format!("{}{}\n", self.get_indent(), contents.as_ref());
+        let mut indented_line = self.get_indent();
+        indented_line.push_str(contents.as_ref());
+        indented_line.push('\n');
+        self.lines.push(indented_line);
+    }
+
+    /// Add an indented line, formatting `args` directly into it. This is what `fmtln!` uses, so
+    /// that formatted lines don't need a temporary string.
+    pub fn line_fmt(&mut self, args: fmt::Arguments) {
+        let mut indented_line = self.get_indent();
+        fmt::Write::write_fmt(&mut indented_line, args).unwrap();
+        indented_line.push('\n');
         self.lines.push(indented_line);
     }
 
@@ -99,11 +107,16 @@ impl Formatter {
 
     /// Emit a line outdented one level.
     pub fn outdented_line(&mut self, s: &str) {
-        let new_line = format!("{}{}\n", self.get_outdent(), s);
+        let mut new_line = self.get_outdent();
+        new_line.push_str(s);
+        new_line.push('\n');
         self.lines.push(new_line);
     }
 
     /// Write `self.lines` to a file.
+    ///
+    /// The file is left untouched if it already holds exactly these contents, so regenerating
+    /// unchanged sources doesn't bump their modification times.
     pub fn update_file(
         &self,
         filename: impl AsRef<str>,
@@ -115,12 +128,16 @@ impl Formatter {
         let path_str = format!("{}/{}", directory, filename.as_ref());
 
         let path = path::Path::new(&path_str);
-        let mut f = fs::File::create(path)?;
-
-        for l in self.lines.iter().map(|l| l.as_bytes()) {
-            f.write_all(l)?;
+        let contents = self.lines.concat();
+        if let Ok(existing) = fs::read(path) {
+            if existing == contents.as_bytes() {
+                return Ok(());
+            }
         }
 
+        let mut f = fs::File::create(path)?;
+        f.write_all(contents.as_bytes())?;
+
         Ok(())
     }
 
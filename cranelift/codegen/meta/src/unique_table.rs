@@ -18,42 +18,46 @@ impl<'entries, T: Eq + Hash> UniqueTable<'entries, T> {
     }
 
     pub fn add(&mut self, entry: &'entries T) -> usize {
-        match self.map.get(&entry) {
-            None => {
-                let i = self.table.len();
-                self.table.push(entry);
-                self.map.insert(entry, i);
-                i
-            }
-            Some(&i) => i,
-        }
+        // Use the entry API so that the entry is only hashed and compared once, whether it's
+        // already in the table or not.
+        let table = &mut self.table;
+        *self.map.entry(entry).or_insert_with(|| {
+            table.push(entry);
+            table.len() - 1
+        })
     }
 
     pub fn len(&self) -> usize {
         self.table.len()
     }
-    pub fn get(&self, index: usize) -> &T {
-        self.table[index]
-    }
     pub fn iter(&self) -> slice::Iter<&'entries T> {
         self.table.iter()
     }
 }
 
 /// A table of sequences which tries to avoid common subsequences.
-pub(crate) struct UniqueSeqTable<T: PartialEq + Clone> {
+pub(crate) struct UniqueSeqTable<T: Eq + Hash + Clone> {
     table: Vec<T>,
+    /// Offsets of the sequences that have already been added, so adding the same sequence again
+    /// doesn't need to scan the table.
+    offsets: HashMap<Vec<T>, usize>,
 }
 
-impl<T: PartialEq + Clone> UniqueSeqTable<T> {
+impl<T: Eq + Hash + Clone> UniqueSeqTable<T> {
     pub fn new() -> Self {
-        Self { table: Vec::new() }
+        Self {
+            table: Vec::new(),
+            offsets: HashMap::new(),
+        }
     }
     pub fn add(&mut self, values: &[T]) -> usize {
         if values.is_empty() {
             return 0;
         }
-        if let Some(offset) = find_subsequence(values, &self.table) {
+        if let Some(&offset) = self.offsets.get(values) {
+            return offset;
+        }
+        let offset = if let Some(offset) = find_subsequence(values, &self.table) {
             offset
         } else {
             let table_len = self.table.len();
@@ -75,7 +79,9 @@ impl<T: PartialEq + Clone> UniqueSeqTable<T> {
             self.table
                 .extend(values[start_from..values.len()].iter().cloned());
             table_len - start_from
-        }
+        };
+        self.offsets.insert(values.to_vec(), offset);
+        offset
     }
     pub fn len(&self) -> usize {
         self.table.len()
@@ -139,3 +145,15 @@ fn test_optimal_add() {
     assert_eq!(seq_table.add(&vec![8]), 8);
     assert_eq!(seq_table.len(), 12);
 }
+
+#[test]
+fn test_unique_add() {
+    let (a, b) = (String::from("a"), String::from("b"));
+    let a_again = a.clone();
+    let mut table = UniqueTable::new();
+    assert_eq!(table.add(&a), 0);
+    assert_eq!(table.add(&b), 1);
+    assert_eq!(table.add(&a_again), 0);
+    assert_eq!(table.len(), 2);
+    assert_eq!(table.iter().collect::<Vec<_>>(), vec![&&a, &&b]);
+}
@@ -24,6 +24,11 @@ pub fn simple_hash(s: &str) -> usize {
 /// Compute an open addressed, quadratically probed hash table containing
 /// `items`. The returned table is a list containing the elements of the
 /// iterable `items` and `None` in unused slots.
+///
+/// The probe sequence visits `hash + i * (i + 1) / 2` modulo the table size, which reaches every
+/// slot of a power-of-two table; this must match the runtime `probe` function.
+///
+/// `hash_function` is called exactly once per item, however many slots are probed for it.
 #[allow(clippy::float_arithmetic)]
 pub fn generate_table<'cont, T, I: iter::Iterator<Item = &'cont T>, H: Fn(&T) -> usize>(
     items: I,
@@ -39,24 +44,51 @@ pub fn generate_table<'cont, T, I: iter::Iterator<Item = &'cont T>, H: Fn(&T) ->
         size.next_power_of_two()
     };
 
+    generate_table_with_size(items, size, hash_function)
+}
+
+/// Compute a table like `generate_table`, but with exactly `size` slots. This allows callers to
+/// pick a lower load factor for tables where failed lookups are common.
+///
+/// The `size` must be a power of two larger than the number of items.
+pub fn generate_table_with_size<
+    'cont,
+    T,
+    I: iter::Iterator<Item = &'cont T>,
+    H: Fn(&T) -> usize,
+>(
+    items: I,
+    size: usize,
+    hash_function: H,
+) -> Vec<Option<&'cont T>> {
+    assert!(
+        size.is_power_of_two(),
+        "hash table size must be a power of two"
+    );
+
     let mut table = vec![None; size];
+    let mask = size - 1;
 
     for i in items {
-        let mut h = hash_function(&i) % size;
+        let mut h = hash_function(&i) & mask;
         let mut s = 0;
         while table[h].is_some() {
             s += 1;
-            h = (h + s) % size;
+            h = (h + s) & mask;
         }
         table[h] = Some(i);
     }
 
+    assert!(
+        table.iter().any(Option::is_none),
+        "hash table must have at least one vacant entry"
+    );
     table
 }
 
 #[cfg(test)]
 mod tests {
-    use super::{generate_table, simple_hash};
+    use super::{generate_table, generate_table_with_size, simple_hash};
 
     #[test]
     fn basic() {
@@ -78,4 +110,12 @@ mod tests {
             ]
         );
     }
+
+    #[test]
+    fn test_generate_table_with_size() {
+        let v = vec!["Hello".to_string(), "world".to_string()];
+        let table = generate_table_with_size(v.iter(), 8, |s| simple_hash(&s));
+        assert_eq!(table.len(), 8);
+        assert_eq!(table.iter().filter(|e| e.is_some()).count(), 2);
+    }
 }
@@ -43,14 +43,12 @@ impl From<u16> for EncodingBits {
 impl EncodingBits {
     /// Constructs a new EncodingBits from parts.
     pub fn new(op_bytes: &[u8], rrr: u16, rex_w: u16) -> Self {
-        assert!(
-            !op_bytes.is_empty(),
-            "op_bytes must include at least one opcode byte"
-        );
+        let (&last_byte, prefix_bytes) = op_bytes
+            .split_last()
+            .expect("op_bytes must include at least one opcode byte");
         let mut new = Self::from(0);
-        let last_byte = op_bytes[op_bytes.len() - 1];
         new.write(OPCODE, last_byte as u16);
-        let prefix: u8 = OpcodePrefix::from_opcode(op_bytes).into();
+        let prefix: u8 = OpcodePrefix::from_prefix_bytes(prefix_bytes).into();
         new.write(OPCODE_PREFIX, prefix as u16);
         new.write(RRR, rrr);
         new.write(REX_W, rex_w);
@@ -121,13 +119,13 @@ impl EncodingBits {
     /// Extracts the PP bits of the OpcodePrefix.
     #[inline]
     pub fn pp(self) -> u8 {
-        self.prefix().to_primitive() & 0x3
+        self.read(OPCODE_PREFIX) & 0x3
     }
 
     /// Extracts the MM bits of the OpcodePrefix.
     #[inline]
     pub fn mm(self) -> u8 {
-        (self.prefix().to_primitive() >> 2) & 0x3
+        (self.read(OPCODE_PREFIX) >> 2) & 0x3
     }
 
     /// Bits for the ModR/M byte for certain opcodes.
@@ -219,15 +217,22 @@ impl Into<u8> for OpcodePrefix {
 
 impl OpcodePrefix {
     /// Convert an opcode prefix to a `u8`; this is a convenience proxy for `Into<u8>`.
+    #[cfg(test)]
     fn to_primitive(self) -> u8 {
         self.into()
     }
 
     /// Extracts the OpcodePrefix from the opcode.
     pub fn from_opcode(op_bytes: &[u8]) -> Self {
-        assert!(!op_bytes.is_empty(), "at least one opcode byte");
+        let (_, prefix_bytes) = op_bytes.split_last().expect("at least one opcode byte");
+        Self::from_prefix_bytes(prefix_bytes)
+    }
 
-        let prefix_bytes = &op_bytes[..op_bytes.len() - 1];
+    /// Extracts the OpcodePrefix from the bytes preceding the opcode byte.
+    ///
+    /// The slice patterns below compile to a length check followed by direct byte comparisons,
+    /// so there is nothing to gain from packing the prefix bytes into an integer key first.
+    fn from_prefix_bytes(prefix_bytes: &[u8]) -> Self {
         match prefix_bytes {
             [] => Self::Op1,
             [0x66] => Self::Mp1_66,
@@ -246,7 +251,7 @@ impl OpcodePrefix {
             [0xf3, 0x0f, 0x3a] => Self::Mp3_f3_0f_3a,
             [0xf2, 0x0f, 0x3a] => Self::Mp3_f2_0f_3a,
             _ => {
-                panic!("unexpected opcode sequence: {:?}", op_bytes);
+                panic!("unexpected opcode prefix: {:?}", prefix_bytes);
             }
         }
     }
@@ -5,8 +5,8 @@ use super::registers::RU;
 use crate::binemit::{bad_encoding, CodeSink, Reloc};
 use crate::ir::condcodes::{CondCode, FloatCC, IntCC};
 use crate::ir::{
-    Block, Constant, ExternalName, Function, Inst, InstructionData, JumpTable, LibCall, Opcode,
-    TrapCode,
+    Block, Constant, ExternalName, FuncRef, Function, Inst, InstructionData, JumpTable, LibCall,
+    Opcode, TrapCode,
 };
 use crate::isa::{RegUnit, StackBase, StackBaseMask, StackRef, TargetIsa};
 use crate::regalloc::RegDiversions;
@@ -15,6 +15,9 @@ use cranelift_codegen_shared::isa::x86::EncodingBits;
 include!(concat!(env!("OUT_DIR"), "/binemit-x86.rs"));
 
 // Convert a stack base to the corresponding register.
+//
+// This is a plain match rather than a lookup table so that `StackBase::Zone`, which has no
+// register assigned yet, fails loudly instead of silently mapping to one of the others.
 fn stk_base(base: StackBase) -> RegUnit {
     let ru = match base {
         StackBase::SP => RU::rsp,
@@ -388,6 +391,39 @@ fn put_evex<CS: CodeSink + ?Sized>(
     // ModR/M byte placed in recipe
 }
 
+/// Encodes a three-byte VEX prefix (C4) and the opcode byte for a scalar (VEX.L = 0) instruction;
+/// for an explanation of the prefix bits, see section 2.3.5 in the Intel Software Development
+/// Manual, volume 2A. Only register-register forms are supported, so VEX.X is always unset.
+fn put_vex3<CS: CodeSink + ?Sized>(
+    bits: u16,
+    reg: RegUnit,
+    vvvv: RegUnit,
+    rm: RegUnit,
+    sink: &mut CS,
+) {
+    let enc = EncodingBits::from(bits);
+
+    // VEX prefix.
+    sink.put1(0xc4);
+
+    debug_assert!(enc.mm() < 0b100);
+    let mut p0 = enc.mm();
+    p0 |= ((!(rm >> 3) & 1) as u8) << 5;
+    p0 |= 1 << 6; // ~X
+    p0 |= ((!(reg >> 3) & 1) as u8) << 7;
+    sink.put1(p0);
+
+    let mut p1 = enc.pp();
+    p1 |= (!(vvvv as u8) & 0b1111) << 3;
+    p1 |= (enc.rex_w() & 0b1) << 7;
+    sink.put1(p1);
+
+    // Opcode
+    sink.put1(enc.opcode_byte());
+
+    // ModR/M byte placed in recipe
+}
+
 /// Emit a ModR/M byte for reg-reg operands.
 fn modrm_rr<CS: CodeSink + ?Sized>(rm: RegUnit, reg: RegUnit, sink: &mut CS) {
     let reg = reg as u8 & 7;
@@ -488,6 +524,62 @@ fn sib<CS: CodeSink + ?Sized>(scale: u8, index: RegUnit, base: RegUnit, sink: &m
     sink.put1(b);
 }
 
+/// Emit the ModR/M byte for a register-indirect address in `base` with no offset. A base of
+/// %rsp or %r12 requires a SIB byte, and a base of %rbp or %r13 requires an explicit zero 8-bit
+/// displacement.
+fn modrm_base<CS: CodeSink + ?Sized>(base: RegUnit, reg: RegUnit, sink: &mut CS) {
+    if needs_sib_byte(base) {
+        modrm_sib(reg, sink);
+        sib_noindex(base, sink);
+    } else if needs_offset(base) {
+        modrm_disp8(base, reg, sink);
+        sink.put1(0);
+    } else {
+        modrm_rm(base, reg, sink);
+    }
+}
+
+/// Emit the ModR/M byte, and a SIB byte if `base` requires one, for a register-indirect address
+/// with an 8-bit displacement. The displacement itself is emitted by the caller.
+fn modrm_base_disp8<CS: CodeSink + ?Sized>(base: RegUnit, reg: RegUnit, sink: &mut CS) {
+    if needs_sib_byte(base) {
+        modrm_sib_disp8(reg, sink);
+        sib_noindex(base, sink);
+    } else {
+        modrm_disp8(base, reg, sink);
+    }
+}
+
+/// Emit the ModR/M byte, and a SIB byte if `base` requires one, for a register-indirect address
+/// with a 32-bit displacement. The displacement itself is emitted by the caller.
+fn modrm_base_disp32<CS: CodeSink + ?Sized>(base: RegUnit, reg: RegUnit, sink: &mut CS) {
+    if needs_sib_byte(base) {
+        modrm_sib_disp32(reg, sink);
+        sib_noindex(base, sink);
+    } else {
+        modrm_disp32(base, reg, sink);
+    }
+}
+
+/// Emit the ModR/M and SIB bytes for an address `base + index << scale` with no offset. A base of
+/// %rbp or %r13 requires an explicit zero 8-bit displacement.
+fn modrm_base_index<CS: CodeSink + ?Sized>(
+    scale: u8,
+    index: RegUnit,
+    base: RegUnit,
+    reg: RegUnit,
+    sink: &mut CS,
+) {
+    if needs_offset(base) {
+        modrm_sib_disp8(reg, sink);
+        sib(scale, index, base, sink);
+        sink.put1(0);
+    } else {
+        modrm_sib(reg, sink);
+        sib(scale, index, base, sink);
+    }
+}
+
 /// Get the low 4 bits of an opcode for an integer condition code.
 ///
 /// Add this offset to a base opcode for:
@@ -496,6 +588,9 @@ fn sib<CS: CodeSink + ?Sized>(scale: u8, index: RegUnit, base: RegUnit, sink: &m
 /// 0x0f 0x80: Long conditional branch.
 /// 0x0f 0x90: SetCC.
 ///
+/// The match over this dense, field-less enum already compiles to a table lookup, and the base
+/// opcode comes from the encoding bits rather than the recipe, so the generated code keeps calling
+/// this instead of carrying per-recipe opcode tables.
 fn icc2opc(cond: IntCC) -> u16 {
     use crate::ir::condcodes::IntCC::*;
     match cond {
@@ -518,6 +613,17 @@ fn icc2opc(cond: IntCC) -> u16 {
     }
 }
 
+/// Emit a `setCC` instruction for the integer condition code `cond`, writing the low byte of `reg`.
+/// No REX prefix is emitted, so `reg` must be one of the ABCD registers.
+///
+/// The bytes are written one at a time, like the ones of the `trapif` recipe; see the comment
+/// above that recipe in the meta crate's `isa/x86/recipes.rs` for why.
+fn setcc_icc<CS: CodeSink + ?Sized>(cond: IntCC, reg: RegUnit, sink: &mut CS) {
+    sink.put1(0x0f);
+    sink.put1(0x90 | icc2opc(cond) as u8);
+    modrm_rr(reg, 0, sink);
+}
+
 /// Get the low 4 bits of an opcode for a floating point condition code.
 ///
 /// The ucomiss/ucomisd instructions set the FLAGS bits CF/PF/CF like this:
@@ -550,6 +656,16 @@ fn fcc2opc(cond: FloatCC) -> u16 {
     }
 }
 
+/// Emit a `setCC` instruction for the floating point condition code `cond`, writing the low byte
+/// of `reg`. No REX prefix is emitted, so `reg` must be one of the ABCD registers.
+///
+/// See `setcc_icc` for why the bytes are written one at a time.
+fn setcc_fcc<CS: CodeSink + ?Sized>(cond: FloatCC, reg: RegUnit, sink: &mut CS) {
+    sink.put1(0x0f);
+    sink.put1(0x90 | fcc2opc(cond) as u8);
+    modrm_rr(reg, 0, sink);
+}
+
 /// Emit a single-byte branch displacement to `destination`.
 fn disp1<CS: CodeSink + ?Sized>(destination: Block, func: &Function, sink: &mut CS) {
     let delta = func.offsets[destination].wrapping_sub(sink.offset() + 1);
@@ -576,3 +692,27 @@ fn const_disp4<CS: CodeSink + ?Sized>(constant: Constant, func: &Function, sink:
     sink.put4(delta);
     sink.reloc_constant(Reloc::X86PCRelRodata4, offset);
 }
+
+/// Emit the relocated four-byte displacement of a direct call to `func_ref` and record the call
+/// site.
+fn call_disp4<CS: CodeSink + ?Sized>(
+    reloc: Reloc,
+    func_ref: FuncRef,
+    func: &Function,
+    inst: Inst,
+    sink: &mut CS,
+) {
+    let srcloc = func.srclocs[inst];
+    // The addend adjusts for the difference between the end of the instruction and the beginning
+    // of the immediate field.
+    sink.reloc_external(srcloc, reloc, &func.dfg.ext_funcs[func_ref].name, -4);
+    sink.put4(0);
+    sink.add_call_site(func.dfg[inst].opcode(), srcloc);
+}
+
+/// Record that the instruction about to be emitted may overflow the stack.
+///
+/// This only adds trap metadata to the sink; no machine code is emitted for it.
+fn stack_overflow_trap<CS: CodeSink + ?Sized>(func: &Function, inst: Inst, sink: &mut CS) {
+    sink.trap(TrapCode::StackOverflow, func.srclocs[inst]);
+}
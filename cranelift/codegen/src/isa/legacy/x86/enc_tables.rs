@@ -1,7 +1,6 @@
 //! Encoding tables for x86 ISAs.
 
 use super::registers::*;
-use crate::bitset::BitSet;
 use crate::cursor::{Cursor, FuncCursor};
 use crate::flowgraph::ControlFlowGraph;
 use crate::ir::condcodes::{FloatCC, IntCC};
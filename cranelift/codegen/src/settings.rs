@@ -354,6 +354,9 @@ pub mod detail {
         /// Default values.
         pub defaults: &'static [u8],
         /// Pairs of (mask, value) for presets.
+        ///
+        /// A `(u8, u8)` pair is already two bytes with no padding, so this is as dense as a table
+        /// of packed `u16`s, and `apply_preset` doesn't need to unpack anything.
         pub presets: &'static [(u8, u8)],
     }
 